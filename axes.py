@@ -15,50 +15,109 @@ EXAMPLE
     axes center_axes, zero=1
     axes zero=1
 
+SEE ALSO
+    axes_stats
 """
 from pymol import cmd
-from pymol import cgo
 from chempy import cpv
-
-
-class PutCenterCallback(object):
-    prev_v = None
-
-    def __init__(self, name, corner=0):
-        self.name = name
-        self.corner = corner
-        self.cb_name = cmd.get_unused_name('_cb')
-
-    def load(self):
-        cmd.load_callback(self, self.cb_name)
+import threading
+import time
+from pathlib import Path
+# Bit of a janky solution but have to inject the cache directory here...
+import sys
+cachedir = Path.home()/"mjtadema_pymol_cache"
+sys.path.append(str(cachedir.absolute()))
+import cgo_cache
+
+
+class AxesDispatcher(object):
+    """
+    One render loop callback that keeps every axes object in its corner
+    Nothing is done while the view is unchanged and at most max_fps
+    updates are done per second. A throttled frame schedules one redraw
+    for when the throttle allows, so the last frame of a drag is not lost.
+    """
+    cb_name = "_axes_cb"
+
+    def __init__(self, max_fps=60):
+        self.axes = {}
+        self.max_fps = max_fps
+        self.prev_key = None
+        self.last = 0.0
+        self.catch_up = None
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.updates = 0
+        self.unchanged = 0
+        self.throttled = 0
+        self.cost = 0.0
+        self.max_cost = 0.0
+
+    def add(self, name, corner=1):
+        self.axes[name] = corner
+        self.prev_key = None
+        if self.cb_name not in cmd.get_names('objects'):
+            cmd.load_callback(self, self.cb_name)
+
+    def remove(self, name):
+        self.axes.pop(name, None)
 
     def __call__(self):
-        if self.name not in cmd.get_names('objects'):
-            import threading
-            threading.Thread(None, cmd.delete, args=(self.cb_name,)).start()
+        if not self.axes:
+            return
+        start = time.perf_counter()
+        self.calls += 1
+        if self.max_fps and start - self.last < 1.0 / self.max_fps:
+            self.throttled += 1
+            if self.catch_up is None:
+                delay = 1.0 / self.max_fps - (start - self.last)
+                self.catch_up = threading.Timer(delay, self.redraw)
+                self.catch_up.daemon = True
+                self.catch_up.start()
             return
-
         v = cmd.get_view()
-        if v == self.prev_v:
+        vp = cmd.get_viewport()
+        key = hash((v, tuple(vp)))
+        if key == self.prev_key:
+            self.unchanged += 1
             return
-        self.prev_v = v
+        self.prev_key = key
+        self.last = start
 
-        t = v[12:15]
-
-        if self.corner:
-            vp = cmd.get_viewport()
-            R_mc = [v[0:3], v[3:6], v[6:9]]
-            off_c = [0.15 * v[11] * vp[0] / vp[1], 0.15 * v[11], 0.0]
-            if self.corner in [2,3]:
-                off_c[0] *= -1
-            if self.corner in [3,4]:
-                off_c[1] *= -1
-            off_m = cpv.transform(R_mc, off_c)
-            t = cpv.add(t, off_m)
+        names = set(cmd.get_names('objects'))
+        for name in [name for name in self.axes if name not in names]:
+            del self.axes[name]
 
+        R_mc = [v[0:3], v[3:6], v[6:9]]
         z = -v[11] / 30.0
-        m = [z, 0, 0, 0, 0, z, 0, 0, 0, 0, z, 0, t[0] / z, t[1] / z, t[2] / z, 1]
-        cmd.set_object_ttt(self.name, m)
+        for name, corner in self.axes.items():
+            t = v[12:15]
+            if corner:
+                off_c = [0.15 * v[11] * vp[0] / vp[1], 0.15 * v[11], 0.0]
+                if corner in [2,3]:
+                    off_c[0] *= -1
+                if corner in [3,4]:
+                    off_c[1] *= -1
+                off_m = cpv.transform(R_mc, off_c)
+                t = cpv.add(t, off_m)
+            m = [z, 0, 0, 0, 0, z, 0, 0, 0, 0, z, 0, t[0] / z, t[1] / z, t[2] / z, 1]
+            cmd.set_object_ttt(name, m)
+
+        cost = time.perf_counter() - start
+        self.updates += 1
+        self.cost += cost
+        self.max_cost = max(self.max_cost, cost)
+
+    def redraw(self):
+        "Catch up on a throttled frame, the redraw calls the dispatcher again"
+        self.catch_up = None
+        cmd.refresh()
+
+
+dispatcher = AxesDispatcher()
+
 
 def axes(name='axes', zero=0):
 
@@ -67,23 +126,46 @@ def axes(name='axes', zero=0):
     s = 1.0
     if int(zero) > 0:
         s = 10.0
-    w = 0.06*s # cylinder width
-    l = 0.75*s # cylinder length
-    h = 0.25*s # cone hight
-    d = w * 1.618 # cone base diameter
-
-    obj = [cgo.CYLINDER, 0.0, 0.0, 0.0,   l, 0.0, 0.0, w, 1.0, 0.0, 0.0, 1.0, 0.0, 0.0,
-           cgo.CYLINDER, 0.0, 0.0, 0.0, 0.0,   l, 0.0, w, 0.0, 1.0, 0.0, 0.0, 1.0, 0.0,
-           cgo.CYLINDER, 0.0, 0.0, 0.0, 0.0, 0.0,   l, w, 0.0, 0.0, 1.0, 0.0, 0.0, 1.0,
-           cgo.CONE,   l, 0.0, 0.0, h+l, 0.0, 0.0, d, 0.0, 1.0, 0.0, 0.0, 1.0, 0.0, 0.0, 1.0, 1.0,
-           cgo.CONE, 0.0,   l, 0.0, 0.0, h+l, 0.0, d, 0.0, 0.0, 1.0, 0.0, 0.0, 1.0, 0.0, 1.0, 1.0,
-           cgo.CONE, 0.0, 0.0,   l, 0.0, 0.0, h+l, d, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 1.0, 1.0, 1.0]
-
+    # Same geometry for every axes object, only the TTT differs
+    cgo_cache.instance('axes', name, cgo_cache.place(s))
     if int(zero) < 1:
         # Keep axis in the corner
-        PutCenterCallback(name, 1).load()
-    cmd.load_cgo(obj, name)
+        dispatcher.add(name, 1)
+    else:
+        dispatcher.remove(name)
 
 axes.__doc__ = __doc__
 cmd.extend('axes', axes)
 
+
+def axes_stats(action="stats", max_fps=None):
+    """
+    DESCRIPTION
+        Show the per frame cost of keeping the axes objects in their corner
+
+    ARGUMENTS
+        action: stats or reset (default: stats)
+        max_fps: limit the axes updates per second, 0 for no limit (default: 60)
+
+    EXAMPLE
+        axes_stats
+        axes_stats reset
+        axes_stats max_fps=20
+    """
+    if max_fps is not None:
+        dispatcher.max_fps = float(max_fps)
+    if action == "reset":
+        dispatcher.reset()
+    elif action != "stats":
+        raise ValueError(f"Unknown action {action}, use stats or reset")
+    d = dispatcher
+    mean = d.cost / d.updates if d.updates else 0.0
+    limit = f"{d.max_fps:g} updates/s" if d.max_fps else "no limit"
+    print(f"Axes: {len(d.axes)} objects, {limit}")
+    print(f"  {d.calls} frames, {d.updates} updates, {d.unchanged} unchanged, "
+          f"{d.throttled} throttled")
+    print(f"  update cost {mean * 1000:.3f} ms mean, {d.max_cost * 1000:.3f} ms max")
+
+cmd.extend('axes_stats', axes_stats)
+cmd.auto_arg[0]['axes_stats'] = [lambda: cmd.Shortcut(["stats", "reset"]), 'action', '']
+
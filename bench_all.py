@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the heavier commands.
+Needs pymol and numpy, run with: python bench_all.py
+"""
+import itertools
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from types import SimpleNamespace
+import numpy as np
+from pymol import cmd
+from chempy import Atom
+from chempy.models import Indexed
+from mindist import get_mindist_np, get_mindist_grid, get_mindist_chunked
+from split_chains import split_chains, split_create, load_chain
+import chain_store
+import coords
+from princ_align import principal_axes_states
+
+
+def timed(func, *args, **kwargs):
+    "return the runtime (s) and peak traced memory (MB) of a call"
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    runtime = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return runtime, peak
+
+
+def random_selection(n_atoms, shift=0.0, seed=0):
+    "Stand-in for mindist.Selection, atoms at roughly protein density"
+    side = (n_atoms / 0.1) ** (1/3)
+    rng = np.random.default_rng(seed)
+    coord = rng.uniform(0, side, (n_atoms, 3))
+    coord[:, 0] += shift * side
+    return SimpleNamespace(index=list(range(n_atoms)), coord=coord.tolist())
+
+
+def first_pairs(engine, *args, count=10, **kwargs):
+    "pull the first count pairs from a mindist engine"
+    return list(itertools.islice(engine(*args, **kwargs), count))
+
+
+def bench_mindist(sizes=(500, 1000, 2000, 4000, 8000, 16000), n=10, mem=64, full_limit=4000):
+    "Peak memory and runtime of the mindist engines against selection size"
+    print(f"{'atoms':>8} {'engine':>8} {'time (s)':>10} {'peak (MB)':>10}")
+    for size in sizes:
+        # Two touching boxes, like two neighbouring chains
+        sele_1 = random_selection(size, seed=0)
+        sele_2 = random_selection(size, shift=1.0, seed=1)
+        engines = [
+            ("grid", get_mindist_grid, {}),
+            ("chunked", get_mindist_chunked, {'n': n, 'mem': mem}),
+        ]
+        if size <= full_limit:
+            engines.append(("full", get_mindist_np, {}))
+        for name, engine, kwargs in engines:
+            runtime, peak = timed(first_pairs, engine, sele_1, sele_2, count=n, **kwargs)
+            print(f"{size:>8} {name:>8} {runtime:>10.3f} {peak:>10.1f}")
+
+
+
+def make_assembly(name, n_chains, atoms_per_chain=2000, seed=0):
+    "Load an object of n_chains chains of loose carbon atoms"
+    rng = np.random.default_rng(seed)
+    model = Indexed()
+    for c in range(n_chains):
+        for k in range(atoms_per_chain):
+            at = Atom()
+            at.chain = f"C{c}"
+            at.resi = str(k // 10 + 1)
+            at.resn = "ALA"
+            at.name = "C"
+            at.symbol = "C"
+            at.coord = rng.uniform(0, 100, 3).tolist()
+            model.add_atom(at)
+    cmd.load_model(model, name)
+
+
+def bench_split_chains(chain_counts=(2, 8, 32, 60), atoms_per_chain=2000):
+    """
+    Runtime of one create per chain against a lazy split that then loads
+    every chain, so both end with the same objects
+    """
+    print(f"{'chains':>8} {'create (s)':>12} {'lazy+load (s)':>14}")
+    for n_chains in chain_counts:
+        make_assembly("bench", n_chains, atoms_per_chain)
+        old = timed(split_create, "bench")[0]
+        cmd.delete("bench*")
+        make_assembly("bench", n_chains, atoms_per_chain)
+        new = timed(split_chains, "bench", color=0, lazy=1)[0]
+        new += timed(load_chain, "bench_")[0]
+        assert not chain_store.pending
+        cmd.delete("bench*")
+        chain_store.order.clear()
+        print(f"{n_chains:>8} {old:>12.3f} {new:>14.3f}")
+
+
+
+def model_coords(selection):
+    "the get_model route the scripts used before coords.py"
+    return np.array([at.coord for at in cmd.get_model(selection).atom])
+
+
+def model_fields(selection):
+    model = cmd.get_model(selection)
+    return [(at.index, at.chain, at.resi) for at in model.atom]
+
+
+def bench_coords(n_atoms=100_000, repeats=3):
+    "Coordinate and field access per 100k atoms, get_model against coords.py"
+    make_assembly("bench", n_atoms // 2000, 2000)
+    cases = [
+        ("get_model coords", model_coords, ("bench",), {}),
+        ("get_coords", coords.get_coords, ("bench",), {}),
+        ("get_model fields", model_fields, ("bench",), {}),
+        ("get_fields", coords.get_fields, ("bench", "index", "chain", "resi"), {}),
+    ]
+    print(f"{'access':>18} {'time (s)':>10} {'peak (MB)':>10}")
+    scale = 100_000 / n_atoms
+    for name, func, args, kwargs in cases:
+        runs = [timed(func, *args, **kwargs) for _ in range(repeats)]
+        runtime = min(run[0] for run in runs) * scale
+        peak = min(run[1] for run in runs) * scale
+        print(f"{name:>18} {runtime:>10.3f} {peak:>10.1f}")
+    cmd.delete("bench")
+
+
+def bench_princ_align_states(frame_counts=(100, 1000, 10000), n_atoms=500):
+    "Batched principal axes of a trajectory of CA atoms against frame count"
+    rng = np.random.default_rng(0)
+    print(f"{'frames':>8} {'time (s)':>10} {'peak (MB)':>10}")
+    for frames in frame_counts:
+        xyz = rng.normal(size=(frames, n_atoms, 3)) * [10, 5, 2]
+        runtime, peak = timed(principal_axes_states, xyz)
+        print(f"{frames:>8} {runtime:>10.3f} {peak:>10.1f}")
+
+
+startup_script = """
+import sys, time
+from pathlib import Path
+from pymol import cmd
+import loader
+cachedir = Path(sys.argv[1])
+modules = {path.name: ('', '') for path in sorted(cachedir.glob('*.py'))}
+start = time.perf_counter()
+if sys.argv[2] == 'lazy':
+    loader.register_stubs(loader.update_index(modules, cachedir), cachedir)
+else:
+    loader.load_modules(modules, cachedir)
+print(time.perf_counter() - start)
+"""
+
+
+def bench_startup(repeats=3):
+    "Module loading at PyMOL startup, every module run against command stubs"
+    here = Path(__file__).parent.absolute()
+    with tempfile.TemporaryDirectory() as tmp:
+        # A cache directory like the loader's, without the repo's own tools
+        for path in here.glob('*.py'):
+            if path.name not in ("loader.py", "readme.py", "test_all.py", "bench_all.py"):
+                shutil.copy(path, tmp)
+
+        def startup(mode):
+            # A fresh interpreter every time, nothing imported yet
+            result = subprocess.run([sys.executable, "-c", startup_script, tmp, mode],
+                                    capture_output=True, text=True, check=True, cwd=here)
+            return float(result.stdout.strip().splitlines()[-1])
+
+        # The first lazy start builds the command index
+        cases = [("eager", "eager"), ("lazy (index)", "lazy"), ("lazy", "lazy")]
+        print(f"{'loading':>14} {'time (s)':>10}")
+        for name, mode in cases:
+            runtime = min(startup(mode) for _ in range(1 if name == "lazy (index)" else repeats))
+            print(f"{name:>14} {runtime:>10.3f}")
+
+
+if __name__ == "__main__":
+    bench_mindist()
+    bench_split_chains()
+    bench_coords()
+    bench_princ_align_states()
+    bench_startup()
@@ -0,0 +1,73 @@
+"""
+DESCRIPTION
+    Context manager for scripted bulk edits (mutate, split_chains, merge_chains)
+    Screen updates, undo and all feedback but errors and warnings are
+    suspended while editing, sorting, coloring and centering are deferred
+    to one call at the end.
+    Settings are restored even if the edit fails.
+
+EXAMPLE
+    with bulk_edit() as edit:
+        cmd.create("obj_A", "obj and chain A")
+        edit.sort("obj_A")
+        edit.center("obj_A")
+"""
+author = "Matthijs J. Tadema, MSc (2020)"
+version = 20261018
+
+from pymol import cmd, util
+from contextlib import contextmanager
+
+
+class BulkEdit:
+    """
+    Keep track of the work deferred to the end of a bulk edit
+    """
+    def __init__(self):
+        self.sort_objects = []
+        self.color_selections = []
+        self.center_selection = None
+
+    def sort(self, obj=''):
+        "sort obj (default: all) once the edit is done"
+        if obj not in self.sort_objects:
+            self.sort_objects.append(obj)
+
+    def color_objs(self, selection):
+        "color selection by object once the edit is done"
+        self.color_selections.append(selection)
+
+    def center(self, selection):
+        "center on selection once the edit is done, the last call wins"
+        self.center_selection = selection
+
+    def finish(self):
+        # An empty name sorts everything, no need to sort anything else
+        if '' in self.sort_objects:
+            cmd.sort()
+        else:
+            for obj in self.sort_objects:
+                cmd.sort(obj)
+        for selection in self.color_selections:
+            util.color_objs(selection)
+        if self.center_selection is not None:
+            cmd.center(self.center_selection)
+
+
+@contextmanager
+def bulk_edit():
+    "Suspend redraw, undo and quiet feedback, run the deferred work when done"
+    settings = {name: cmd.get(name) for name in ("suspend_updates", "suspend_undo")}
+    cmd.feedback("push")
+    # Errors and warnings stay, they explain a failing step
+    cmd.feedback("disable", "all", "actions results details blather")
+    cmd.set("suspend_updates", 1)
+    cmd.set("suspend_undo", 1)
+    edit = BulkEdit()
+    try:
+        yield edit
+        edit.finish()
+    finally:
+        for name, value in settings.items():
+            cmd.set(name, value)
+        cmd.feedback("pop")
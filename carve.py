@@ -1,59 +1,262 @@
 """
 DESCRIPTION
     Clip a selection through the ZY-plane of its principal axes
+    or perpendicular to any other axis of the aligned frame.
+    The atoms in the slab are stored as a selection and counted.
+    With a start:stop range the slab is cut between two planes, with a step
+    a series of slabs is swept from start to stop and every slab is ray traced
+    to a png by a pool of headless pymol processes.
 
 ARGUMENTS
     selection: selection string
-    cut_range: slab thickness
+    cut_range: slab thickness, or start:stop along the axis
     view_key: optionally store the resulting view as an F key
+    axis: x, y or z, the axis perpendicular to the slab (default: y)
+    name: name of the slab selection (default: slab)
+    planes: show the slab edges as planes name_lo and name_hi (default: 0)
+    thickness: slab thickness of a series (default: 5)
+    step: sweep a series of slabs from start to stop with this step
+    out: file prefix of the series pngs (default: carve)
+    width: png width in pixels (default: 1200)
+    height: png height in pixels (default: 900)
+    processes: number of render processes (default: number of cpus)
 
 EXAMPLE
     carve
     carve obj1
     carve obj1, 20
-    carve obj1, view_key=F1 
+    carve obj1, -10:30
+    carve obj1, 10, axis=x, name=pore
+    carve obj1, -10:30, planes=1
+    carve obj1, view_key=F1
+    carve obj1, -40:40, thickness=4, step=2, out=pore/slab
 
 """
 # Beware these are crude early versions, only possible to align with z axis for now
 author = "Matthijs J. Tadema, MSc (2020)"
-version = 20201217
+version = 20261018
 from pymol import cmd
+try:
+    import numpy as np
+except:
+    np = None
+import math
+import multiprocessing
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 # Bit of a janky solution but have to inject the cache directory here...
 import sys
 cachedir = Path.home()/"mjtadema_pymol_cache"
 sys.path.append(str(cachedir.absolute()))
 from princ_align import princ_align
+import coords
+import cgo_cache
+import session_cache
+
+# The pymol instance of a render worker process
+_render = {}
+# Model to camera rotations looking down the slab axis,
+# the rows are the camera axes in model space
+cameras = {
+    'x': [[0, 1, 0], [0, 0, 1], [1, 0, 0]],
+    'y': [[1, 0, 0], [0, 0, 1], [0, -1, 0]],
+    'z': [[1, 0, 0], [0, 1, 0], [0, 0, 1]],
+}
+
+
+def camera(axis):
+    "rotation of a view down axis, column-major like cmd.get_view"
+    rows = cameras[axis]
+    return [rows[i][j] for j in range(3) for i in range(3)]
+
+
+def slab_view(view, axis, lo, hi):
+    """
+    View down axis with the clipping planes at lo and hi along it
+    view: view (cmd.get_view) that has the origin and camera distance
+    """
+    view = list(view)
+    view[0:9] = camera(axis)
+    a = "xyz".index(axis)
+    # The camera z axis points along +axis or -axis,
+    # depth is the distance to the origin minus the offset along it
+    toward = cameras[axis][2][a]
+    distance = -view[11]
+    depths = [distance - toward * (bound - view[12 + a]) for bound in (lo, hi)]
+    view[15], view[16] = min(depths), max(depths)
+    return view
+
+
+def base_view(selection, axis):
+    "Look down axis with the whole selection in view"
+    view = list(cmd.get_view())
+    view[0:9] = camera(axis)
+    cmd.set_view(view)
+    cmd.zoom(selection, complete=1)
+    return cmd.get_view()
+
+
+def residue_table(fields):
+    "residue number (0..) of every atom, from its object, chain and resi"
+    keys = np.rec.fromarrays([fields['model'], fields['chain'], fields['resi']])
+    return np.unique(keys, return_inverse=True)[1]
+
+
+class Slabs:
+    """
+    Aligned coordinates of a selection along the slab axis,
+    membership and counts of slabs come from masks over these
+    """
+    def __init__(self, selection, axis):
+        fields = coords.cached_fields(selection, "model", "index", "chain", "resi", state=-1)
+        self.model = fields['model']
+        self.index = fields['index']
+        self.axis = axis
+        self.xyz = coords.get_coords(selection)
+        self.position = self.xyz[:, "xyz".index(axis)]
+        self.residue = session_cache.cached("residues", selection, coords.current_state(-1),
+                lambda: residue_table(fields), coordinates=False)
+
+    def mask(self, lo, hi):
+        return (self.position >= lo) & (self.position <= hi)
+
+    def count(self, mask):
+        "atoms and residues in the slab"
+        return int(mask.sum()), len(np.unique(self.residue[mask]))
+
+    def counts(self, slabs):
+        "atoms and residues of every (lo, hi) slab, from one sort"
+        order = np.argsort(self.position, kind="stable")
+        position, residue = self.position[order], self.residue[order]
+        lo, hi = np.array(slabs, dtype=float).T
+        first = np.searchsorted(position, lo, 'left')
+        last = np.searchsorted(position, hi, 'right')
+        return [(int(b - a), len(np.unique(residue[a:b]))) for a, b in zip(first, last)]
+
+    def select(self, name, mask):
+        "store the slab as a selection, one index list per object"
+        cmd.select(name, "none")
+        for obj in np.unique(self.model[mask]):
+            index = self.index[mask & (self.model == obj)].tolist()
+            cmd.select_list("_carve", str(obj), index, mode='index')
+            cmd.select(name, f"{name} or _carve")
+        cmd.delete("_carve")
+
+    def planes(self, name, lo, hi):
+        "planes at both edges of the slab, copies of one cached plane"
+        a = "xyz".index(self.axis)
+        low, high = self.xyz.min(axis=0), self.xyz.max(axis=0)
+        scale = [max(extent, 1.0) for extent in high - low]
+        scale[a] = 1.0
+        center = list((high + low) / 2)
+        for side, bound in [("lo", lo), ("hi", hi)]:
+            center[a] = bound
+            cgo_cache.instance(f"plane_{self.axis}", f"{name}_{side}",
+                               cgo_cache.place(scale, center))
+
+
+def slab_ranges(start, stop, thickness, step):
+    "(lo, hi) of every slab swept from start to stop"
+    count = math.floor((stop - start - thickness) / step + 1e-9) + 1
+    return [(start + i*step, start + i*step + thickness) for i in range(max(count, 0))]
+
+
+def render_init(path):
+    "Start a headless pymol in a worker process and load the session once"
+    from pymol2 import PyMOL
+    pymol = PyMOL()
+    pymol.start()
+    pymol.cmd.load(path)
+    _render.update(pymol=pymol)
+
+
+def render_one(view, path, width, height):
+    "Ray trace one slab in the worker's pymol"
+    wcmd = _render['pymol'].cmd
+    wcmd.set_view(view)
+    wcmd.png(path, width=width, height=height, ray=1)
+    return path
+
+
+def carve_series(selection, start, stop, thickness, step, axis="y", out="carve",
+                 width=1200, height=900, processes=None):
+    "Sweep a slab from start to stop and ray trace every slab in parallel"
+    slabs = slab_ranges(start, stop, thickness, step)
+    if not slabs:
+        raise ValueError(f"No slab of thickness {thickness} fits in {start}:{stop}")
+    begin = time.perf_counter()
+    counts = Slabs(selection, axis).counts(slabs)
+    base = base_view(selection, axis)
+    views = [slab_view(base, axis, lo, hi) for lo, hi in slabs]
+    paths = [f"{out}_{i:04d}.png" for i in range(len(slabs))]
+    Path(out).parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        # Workers load the session once from file
+        session = str(Path(tmp)/"carve.pse")
+        cmd.save(session)
+        # Fresh processes, a forked copy of a running GUI is no place for a pymol instance
+        ctx = multiprocessing.get_context("spawn")
+        # Workers need the functions from the module, not from a cmd.run namespace
+        from carve import render_init, render_one
+        with ProcessPoolExecutor(max_workers=processes, mp_context=ctx,
+                                 initializer=render_init, initargs=(session,)) as pool:
+            n = len(views)
+            paths = list(pool.map(render_one, views, paths, [width]*n, [height]*n))
+    cmd.set_view(views[0])
+    print(f"{'slab':>6} {'from':>8} {'to':>8} {'atoms':>8} {'residues':>8}  png")
+    for i, ((lo, hi), (atoms, residues), path) in enumerate(zip(slabs, counts, paths)):
+        print(f"{i:>6} {lo:>8.1f} {hi:>8.1f} {atoms:>8} {residues:>8}  {path}")
+    print(f"Rendered {len(paths)} slabs to {out}_*.png in {time.perf_counter() - begin:.2f} s")
+    return paths
 
 
 @cmd.extend
-def carve(selection='(all)', cut_range="5", view_key=None):
-    cut_range = cut_range.split(":")
+def carve(selection='(all)', cut_range="5", view_key=None, thickness=5, step=None,
+          out="carve", width=1200, height=900, processes=None, axis="y", name="slab",
+          planes=0):
+    if np is None:
+        print("This command will not work without numpy.\nConsider installing numpy (or anaconda, provides numpy).")
+        return
+    axis = str(axis).lower()
+    if axis not in cameras:
+        raise ValueError(f"Unknown axis {axis}, use x, y or z")
     try:
-        cut_range = [int(n) for n in cut_range]
-    except ValueError as e:
-        msg = f"Malformed range {cut_range}"
-        e.message = msg
-        raise e
-
-    # First align to principal axes
-    princ_align(selection)
-    cachedir = Path.home()/"mjtadema_pymol_cache"
+        cut_range = [float(n) for n in str(cut_range).split(":")]
+    except ValueError:
+        raise ValueError(f"Malformed range {cut_range}")
     if len(cut_range) == 1:
         # symmetrically cut with thickness t
         t = cut_range[0]
-        cut_select = f"{selection} and (y > {-t} and y < {t})"
-        cmd.orient(cut_select)
-        cmd.clip('slab', t*2, cut_select)
-        if view_key is not None:
-            cmd.view(view_key, 'store')
+        start, stop = -t, t
     elif len(cut_range) == 2:
         # cut from start to end
-        raise NotImplementedError("Didn't get to asymmetric cuts yet")
-        pass
+        start, stop = cut_range
     else:
         # panic
         raise ValueError("range can be at most 2 integers")
+    if start >= stop:
+        raise ValueError(f"Empty range {start}:{stop}")
+
+    # First align to principal axes, once for the whole series
+    princ_align(selection)
+    if step is not None:
+        if processes is not None:
+            processes = int(processes)
+        return carve_series(selection, start, stop, float(thickness), float(step),
+                            axis, out, int(width), int(height), processes)
+    slab = Slabs(selection, axis)
+    mask = slab.mask(start, stop)
+    slab.select(name, mask)
+    if int(planes):
+        slab.planes(name, start, stop)
+    atoms, residues = slab.count(mask)
+    print(f"{name}: {atoms} atoms, {residues} residues between {axis} = {start:.1f} and {stop:.1f}")
+    cmd.set_view(slab_view(base_view(selection, axis), axis, start, stop))
+    if view_key is not None:
+        cmd.view(view_key, 'store')
+    return atoms, residues
 
 carve.__doc__ = __doc__
 cmd.auto_arg[0]['carve'] = [cmd.selection_sc, 'selection', ', ']
@@ -0,0 +1,96 @@
+"""
+DESCRIPTION
+    Shared CGO geometry for the overlays of the scripts
+    Every kind of geometry (axes, slab planes) is built once at unit size
+    as a compact float array and loaded once as a hidden template object.
+    Overlays are copies of the template placed with a TTT matrix,
+    so a new overlay doesn't rebuild or upload any geometry.
+
+EXAMPLE
+    instance("axes", "axes", place(10))
+    instance("plane_y", "cut", place((40, 1, 30), (0, -5, 0)))
+"""
+author = "Matthijs J. Tadema, MSc (2020)"
+version = 20261018
+
+from pymol import cmd
+from pymol import cgo
+from array import array
+
+
+def arrow(direction, color, l=0.75, w=0.06, h=0.25):
+    "cylinder with a cone from the origin along a unit direction"
+    d = w * 1.618 # cone base diameter
+    tip = [l * n for n in direction]
+    end = [(h + l) * n for n in direction]
+    return [cgo.CYLINDER, 0.0, 0.0, 0.0, *tip, w, *color, *color,
+            cgo.CONE, *tip, *end, d, 0.0, *color, *color, 1.0, 1.0]
+
+
+def axes_cgo():
+    "x, y and z arrows in red, green and blue"
+    units = [(1.0, 0.0, 0.0), (0.0, 1.0, 0.0), (0.0, 0.0, 1.0)]
+    return [value for unit in units for value in arrow(unit, unit)]
+
+
+def plane_cgo(axis, color=(0.8, 0.8, 0.8), alpha=0.4):
+    "translucent unit square through the origin, perpendicular to axis"
+    a = "xyz".index(axis)
+    u, v = [i for i in range(3) if i != a]
+    normal = [0.0] * 3
+    normal[a] = 1.0
+    vertices = []
+    for du, dv in [(-0.5, -0.5), (0.5, -0.5), (-0.5, 0.5), (0.5, 0.5)]:
+        vertex = [0.0] * 3
+        vertex[u], vertex[v] = du, dv
+        vertices += [cgo.VERTEX, *vertex]
+    return [cgo.ALPHA, alpha, cgo.COLOR, *color,
+            cgo.BEGIN, cgo.TRIANGLE_STRIP, cgo.NORMAL, *normal,
+            *vertices, cgo.END]
+
+
+builders = {
+    'axes': axes_cgo,
+    'plane_x': lambda: plane_cgo('x'),
+    'plane_y': lambda: plane_cgo('y'),
+    'plane_z': lambda: plane_cgo('z'),
+}
+
+# kind -> geometry as a float array
+templates = {}
+
+
+def geometry(kind):
+    "the CGO of kind, built on first use"
+    if kind not in templates:
+        templates[kind] = array('f', builders[kind]())
+    return templates[kind]
+
+
+def place(scale=1.0, center=(0.0, 0.0, 0.0)):
+    "TTT matrix that scales (a number or one per axis) and then moves to center"
+    if not isinstance(scale, (list, tuple)):
+        scale = (scale,) * 3
+    sx, sy, sz = (float(s) for s in scale)
+    x, y, z = center
+    # The last row is a translation applied before the scaling
+    return [sx, 0, 0, 0, 0, sy, 0, 0, 0, 0, sz, 0, x / sx, y / sy, z / sz, 1]
+
+
+def instance(kind, name, ttt=None):
+    """
+    Make object name with the geometry of kind, placed with ttt
+    """
+    template = f"_cgo_{kind}"
+    if template not in cmd.get_names('objects'):
+        cmd.load_cgo(geometry(kind).tolist(), template)
+        cmd.disable(template)
+    cmd.delete(name)
+    cmd.copy(name, template)
+    if name not in cmd.get_names('objects'):
+        # No copies of CGO objects in this pymol, upload the built geometry
+        cmd.load_cgo(geometry(kind).tolist(), name)
+    cmd.enable(name)
+    if ttt is not None:
+        cmd.set_object_ttt(name, ttt)
+    return name
@@ -0,0 +1,47 @@
+"""
+DESCRIPTION
+    Bookkeeping shared by split_chains and merge_chains
+    Chains split with lazy=1 wait in a hidden source object
+    until they are loaded as objects. The chain objects of every split
+    object are kept in order so merge_chains can put them back that way.
+"""
+author = "Matthijs J. Tadema, MSc (2020)"
+version = 20261018
+
+from pymol import cmd
+
+# Carbon colors by chain, the start of the cycle util.color_objs uses
+colors = ["carbon", "cyan", "lightmagenta", "yellow",
+          "salmon", "hydrogen", "slate", "orange"]
+
+# chain object name -> (source object, chain, carbon color or None), not loaded yet
+pending = {}
+# original object name -> chain object names in the order they were split
+order = {}
+
+
+def source_name(obj):
+    "hidden object holding the pending chains of obj"
+    return f"_{obj}_chains"
+
+
+def materialize(name):
+    "Create a pending chain object, return whether it was pending"
+    entry = pending.pop(name, None)
+    if entry is None:
+        return False
+    source, chain, color = entry
+    # Quoted, so a blank chain identifier selects too
+    cmd.create(name, f'{source} and chain "{chain}"')
+    cmd.color('atomic', name)
+    if color is not None:
+        cmd.color(color, f"elem C and {name}")
+    # The source goes once its last chain is out
+    if all(entry[0] != source for entry in pending.values()):
+        cmd.delete(source)
+    return True
+
+
+def pending_names(prefix=''):
+    "names of the pending chain objects starting with prefix"
+    return [name for name in pending if name.startswith(prefix)]
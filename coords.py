@@ -0,0 +1,121 @@
+"""
+DESCRIPTION
+    Shared coordinate access for the scripts
+    Coordinates come back as contiguous numpy arrays (cmd.get_coords) and
+    per-atom fields as typed arrays from a single iterate pass, instead of
+    building a chempy model with an Atom object for every atom.
+    Without numpy plain lists are returned.
+    The cached_ variants go through the session cache (see cache_stats)
+    and return read-only arrays.
+
+EXAMPLE
+    xyz = get_coords("chain A and name CA")
+    fields = get_fields("chain A", "model", "index", "resi")
+    fields = cached_fields("chain A", "model", "index", "resi")
+    xyz = get_states_coords("name CA", parse_states("all", "name CA"))
+    for part in atom_chunks("all"): xyz = get_coords(part)
+"""
+author = "Matthijs J. Tadema, MSc (2020)"
+version = 20261018
+
+from pymol import cmd
+try:
+    import numpy as np
+except:
+    np = None
+import session_cache
+
+# numpy types of the numeric atom fields, everything else is a string
+field_types = {
+    'index': 'i8', 'ID': 'i8', 'rank': 'i8', 'resv': 'i8', 'formal_charge': 'i8',
+    'b': 'f8', 'q': 'f8', 'vdw': 'f8', 'partial_charge': 'f8',
+    'x': 'f8', 'y': 'f8', 'z': 'f8',
+}
+
+
+def get_coords(selection, state=-1, dtype="float64"):
+    "coordinates of selection as a contiguous (atoms, 3) array"
+    if np is None:
+        xyz = []
+        cmd.iterate_state(state, selection, "xyz.append((x, y, z))", space={'xyz': xyz})
+        return xyz
+    coords = cmd.get_coords(selection, state)
+    if coords is None:
+        return np.empty((0, 3), dtype=dtype)
+    return np.ascontiguousarray(coords, dtype=dtype)
+
+
+def parse_states(states, selection, stride=1):
+    "convert start:stop (inclusive) or all to a list of states"
+    if str(states).lower() == "all":
+        start, stop = 1, cmd.count_states(selection)
+    else:
+        bounds = [int(n) for n in str(states).split(":")]
+        if len(bounds) == 1:
+            start = stop = bounds[0]
+        elif len(bounds) == 2:
+            start, stop = bounds
+        else:
+            raise ValueError("states can be at most 2 integers")
+    return list(range(start, stop + 1, int(stride)))
+
+
+def get_states_coords(selection, states, dtype="float64"):
+    """
+    coordinates of selection in every state, stacked as (states, atoms, 3)
+    The selection needs the same atoms in every state.
+    """
+    xyz = np.empty((len(states), cmd.count_atoms(selection), 3), dtype=dtype)
+    for frame, state in enumerate(states):
+        coords = cmd.get_coords(selection, state)
+        if coords is None or len(coords) != xyz.shape[1]:
+            raise ValueError(f"{selection} does not have the same atoms in state {state}")
+        xyz[frame] = coords
+    return xyz
+
+
+def atom_chunks(selection, chunk=100000):
+    "selections of at most chunk atoms each that together cover selection"
+    for obj in cmd.get_object_list(selection) or []:
+        for start in range(1, cmd.count_atoms(obj) + 1, chunk):
+            yield f"({selection}) and model {obj} and index {start}-{start + chunk - 1}"
+
+
+def get_fields(selection, *fields, state=None):
+    """
+    Per-atom fields of selection from one iterate pass
+    state: iterate over the atoms with coordinates in this state,
+           to line up with get_coords
+    return: dict of field -> array (list without numpy)
+    """
+    rows = []
+    expression = f"rows.append(({', '.join(fields)},))"
+    if state is None:
+        cmd.iterate(selection, expression, space={'rows': rows})
+    else:
+        cmd.iterate_state(state, selection, expression, space={'rows': rows})
+    columns = list(zip(*rows)) if rows else [()] * len(fields)
+    if np is None:
+        return {field: list(column) for field, column in zip(fields, columns)}
+    return {field: np.array(column, dtype=field_types.get(field, str))
+            for field, column in zip(fields, columns)}
+
+
+def current_state(state):
+    "the actual state number, so the cache doesn't mix up states"
+    return cmd.get_state() if state == -1 else state
+
+
+def cached_coords(selection, state=-1):
+    "get_coords through the session cache, the array is read-only"
+    state = current_state(state)
+    return session_cache.cached("coords", selection, state,
+            lambda: get_coords(selection, state))
+
+
+def cached_fields(selection, *fields, state=None):
+    "get_fields through the session cache, the arrays are read-only"
+    if state is not None:
+        state = current_state(state)
+    return session_cache.cached(("fields",) + fields, selection, state,
+            lambda: get_fields(selection, *fields, state=state), coordinates=False)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+DESCRIPTION
+    Calculate the minimum distance and the contacting residues
+    between every pair of chains in a selection, or between every
+    pair of a list of selections. Pairs are computed in parallel.
+    No distance objects are made unless asked for.
+
+ARGUMENTS
+    selection   : selection string, split by chain (default: all)
+    groups      : space separated selections or objects to compare instead of chains
+    cutoff      : contact distance in Angstrom (default: 4)
+    out         : save the table to .csv, or the distance matrix to .npy
+    distances   : make a distance object for the closest pair of each group pair (default: 0)
+    processes   : number of worker processes (default: number of cpus)
+
+EXAMPLE
+    interface_matrix
+    interface_matrix 7ahl, cutoff=5, out=interfaces.csv
+    interface_matrix groups=receptor ligand1 ligand2, distances=1
+"""
+author = "Matthijs J. Tadema, MSc (2020)"
+version = 20261018
+
+from pymol import cmd
+import csv
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from pathlib import Path
+# Bit of a janky solution but have to inject the cache directory here...
+import sys
+cachedir = Path.home()/"mjtadema_pymol_cache"
+sys.path.append(str(cachedir.absolute()))
+from mindist import Selection, get_contacts_shared
+
+
+def residue_label(sele, pos):
+    "object/chain/resi label of the residue of the atom at pos"
+    obj, chain, resi = sele.residue(pos)
+    return f"{obj}/{chain}/{resi}"
+
+
+def compute_pairs(seles, cutoff=4.0, processes=None):
+    """
+    Run every pair of selections through the mindist grid engine
+    Coordinates are put in shared memory once, workers only get row ranges.
+    return: list of (a, b, distance, closest pair, contact pairs), positions local to each selection
+    """
+    coords = np.concatenate([np.asarray(s.coord, dtype=np.float64).reshape(-1, 3) for s in seles])
+    bounds = np.cumsum([0] + [len(s.index) for s in seles]).tolist()
+    pairs = list(itertools.combinations(range(len(seles)), 2))
+    shm = shared_memory.SharedMemory(create=True, size=max(coords.nbytes, 1))
+    try:
+        shared = np.ndarray(coords.shape, dtype=np.float64, buffer=shm.buf)
+        shared[:] = coords
+        del shared
+        # Fresh processes, a forked copy of a running GUI is no place for a worker
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=processes, mp_context=ctx) as pool:
+            futures = [pool.submit(get_contacts_shared, shm.name, coords.shape,
+                                   (bounds[a], bounds[a+1]), (bounds[b], bounds[b+1]), cutoff)
+                       for a, b in pairs]
+            results = [future.result() for future in futures]
+    finally:
+        shm.close()
+        shm.unlink()
+    table = []
+    for (a, b), (dmin, closest, contacts) in zip(pairs, results):
+        # Back to positions within each selection
+        if closest is not None:
+            closest = (closest[0] - bounds[a], closest[1] - bounds[b])
+        contacts = [(i - bounds[a], j - bounds[b]) for i, j in contacts]
+        table.append((a, b, dmin, closest, contacts))
+    return table
+
+
+def interface_matrix(selection='(all)', groups=None, cutoff=4, out=None, distances=0, processes=None):
+    if groups is None:
+        names = cmd.get_chains(selection)
+        # Quoted, so blank chain identifiers select too
+        group_sels = [f'({selection}) and chain "{chain}"' for chain in names]
+    else:
+        names = groups.split() if isinstance(groups, str) else list(groups)
+        group_sels = [f"({selection}) and ({group})" for group in names]
+    if len(names) < 2:
+        raise ValueError("Need at least two chains or groups to compare")
+    if processes is not None:
+        processes = int(processes)
+    seles = [Selection(sele) for sele in group_sels]
+    table = compute_pairs(seles, cutoff=float(cutoff), processes=processes)
+
+    matrix = np.zeros((len(names), len(names)))
+    rows = []
+    for a, b, dmin, closest, contacts in table:
+        matrix[a, b] = matrix[b, a] = dmin
+        # Unique residue pairs rather than atom pairs
+        res_pairs = {}
+        for i, j in contacts:
+            res_pairs.setdefault((residue_label(seles[a], i), residue_label(seles[b], j)), None)
+        rows.append((names[a], names[b], dmin, [f"{r1}-{r2}" for r1, r2 in res_pairs]))
+        if int(distances) == 1 and closest is not None:
+            i, j = closest
+            cmd.distance(f"iface_{names[a]}_{names[b]}", seles[a].atom(i), seles[b].atom(j))
+
+    width = max(max(len(str(name)) for name in names), 7) + 2
+    print("".ljust(width) + "".join(str(name).rjust(width) for name in names))
+    for name, row in zip(names, matrix):
+        print(str(name).ljust(width) + "".join(f"{d:.2f}".rjust(width) for d in row))
+    for name_a, name_b, dmin, res_pairs in rows:
+        if res_pairs:
+            print(f"{name_a}-{name_b}: {len(res_pairs)} residue contacts")
+
+    if out is not None:
+        if str(out).endswith(".npy"):
+            np.save(out, matrix)
+        else:
+            with open(out, 'w', newline='') as fout:
+                writer = csv.writer(fout)
+                writer.writerow(["group_1", "group_2", "distance", "n_contacts", "contacts"])
+                for name_a, name_b, dmin, res_pairs in rows:
+                    writer.writerow([name_a, name_b, f"{dmin:.3f}", len(res_pairs), " ".join(res_pairs)])
+        print(f"Saved {out}")
+    return names, matrix, rows
+
+interface_matrix.__doc__ = __doc__
+cmd.extend('interface_matrix', interface_matrix)
+
+cmd.auto_arg[0]['interface_matrix'] = [cmd.selection_sc, 'selection', ', ']
+cmd.auto_arg[1]['interface_matrix'] = [cmd.selection_sc, 'groups', ', ']
+cmd.auto_arg[2]['interface_matrix'] = ['', 'contact cutoff', '']
@@ -2,17 +2,29 @@
 Loader script to dynamically load pymol scripts in pymol
 """
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from pymol import cmd
 from pathlib import Path
 from datetime import datetime
+import ast
+import importlib
+import inspect
 import json
+import os
+import sys
+import time
 from hashlib import sha1 as sha
 
 author = "Matthijs J. Tadema, MSc (2020)"
-version = 20201214
+version = 20261018
+
+api_url = r'https://api.github.com/repos/mjtadema/public_pymol_scripts/contents?ref=master'
+# (connect, read) timeouts in seconds, so a bad connection can't hang pymol
+timeout = (3.05, 10)
 
 
-class ResponseOutOfDate(Exception): pass
 class RateLimit(Exception): pass
 
 
@@ -20,77 +32,326 @@ def delta_hours(somepath: Path):
     "return the hours delta to now"
     previous_response_time = datetime.fromtimestamp(somepath.stat().st_mtime)
     delta = datetime.now() - previous_response_time
-    return delta.seconds / 3600
+    return delta.total_seconds() / 3600
 
 
-cachedir = Path.home()/"mjtadema_pymol_cache"
-cachedir.mkdir(exist_ok=True)
-response_file = cachedir/"pymol_loader.json"
+def write_atomic(path: Path, data: bytes):
+    "write to a temporary file first, so an interrupted write leaves the old file"
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, 'wb') as fout:
+        fout.write(data)
+    os.replace(tmp, path)
 
-try:
-    # Check for a cached repo response
-    if not response_file.exists():
-        raise FileNotFoundError
 
-    # Check if file is out of date
-    # This can be much much longer, changed to 24
-    if delta_hours(response_file) >= 24:
-        raise ResponseOutOfDate
+def make_session(retries=3, workers=8):
+    "keep-alive session that retries failed requests a few times with backoff"
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))
+    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
-    print("Reading cached list")
-    with response_file.open() as rfh:
-        objects = json.load(rfh)
 
-except (FileNotFoundError, ResponseOutOfDate):
-    # Query the git repo for all files in root of branch master 
+def get_listing(session, cachedir: Path, url=api_url, max_age=24):
+    """
+    Contents of the git repo, cached for max_age hours and revalidated
+    with its ETag after that, an unchanged list costs a single 304
+    """
+    response_file = cachedir/"pymol_loader.json"
+    etag_file = cachedir/"pymol_loader.etag"
+    if response_file.exists() and delta_hours(response_file) < max_age:
+        print("Reading cached list")
+        with response_file.open() as rfh:
+            return json.load(rfh)
+
     print("Querying for new list")
-    response = requests.get(r'https://api.github.com/repos/mjtadema/public_pymol_scripts/contents?ref=master')
-    if response.status_code != 200:
-        raise RateLimit("Hit rate limiter, try again later")
+    headers = {}
+    if response_file.exists() and etag_file.exists():
+        headers['If-None-Match'] = etag_file.read_text().strip()
+    try:
+        response = session.get(url, headers=headers, timeout=timeout)
+        status = response.status_code
+    except requests.RequestException:
+        if not response_file.exists():
+            raise
+        status = None
 
-    # Cache the response to file to avoid rate limiter
-    with open(response_file, 'w') as cache_out:
-        cache_out.write(response.text) 
+    if status == 200:
+        # Cache the response to file to avoid rate limiter
+        write_atomic(response_file, response.content)
+        etag = response.headers.get('ETag')
+        if etag:
+            write_atomic(etag_file, etag.encode())
+    elif status == 304:
+        print("Cached list is up to date")
+        response_file.touch()
+    elif response_file.exists():
+        print("Could not query the list, reading cached list")
+    else:
+        raise RateLimit("Hit rate limiter, try again later")
+    with response_file.open() as rfh:
+        return json.load(rfh)
 
-    objects = response.json()
 
 # Search for pymol modules
-exclude = ["loader.py", "readme.py", "test_all.py"]
-modules = {}
-for obj in objects:
-    name = obj['name']
-    if name in exclude: continue
-    if name.endswith(".py"):
-        # Add also file hash
-        modules[obj['name']] = (obj['download_url'], obj['sha'])
-
-# Update cached modules
-for module, (url, hash_remote) in modules.items():
-    module_path = Path(cachedir / module)
+exclude = ["loader.py", "readme.py", "test_all.py", "bench_all.py"]
+# Shared code, cached so the scripts can import it but not run on its own
+libraries = ["bulk_edit.py", "chain_store.py", "coords.py", "session_cache.py", "cgo_cache.py"]
+
+
+def list_modules(objects):
+    "module -> (download url, git hash) for the scripts in the listing"
+    modules = {}
+    for obj in objects:
+        name = obj['name']
+        if name in exclude: continue
+        if name.endswith(".py"):
+            # Add also file hash
+            modules[name] = (obj['download_url'], obj['sha'])
+    return modules
+
+
+def blob_hash(module_path: Path):
+    "git hash of a file"
+    with open(module_path, 'rb') as file_to_hash:
+        b_file = file_to_hash.read()
+    # Apparently git uses this weird way of hashing files which includes
+    # "blob {length of file}\0" (\0 being NULL)
+    b_blob = b'blob ' + bytearray(str(len(b_file)), 'utf-8') + b'\0'
+    return sha(b_blob + b_file).hexdigest()
+
+
+def read_manifest(cachedir: Path):
+    "module -> size, mtime and git hash of the cached modules at the last start"
     try:
-        assert module_path.exists()
-        # Change this to test for changes (/w file hashes)
-        with open(module_path, 'rb') as file_to_hash:
-            b_file = file_to_hash.read()
-            # Apparently git uses this weird way of hashing files which includes
-            # "blob {length of file}\0" (\0 being NULL)
-            b_blob = b'blob ' + bytearray(str(len(b_file)), 'utf-8') + b'\0'
-            hash_local = sha(b_blob + b_file).hexdigest()
-        print(f"Reading {module} hash")
-        print(f"Remote hash {hash_remote}")
-        print(f"Local hash {hash_local}")
-        assert hash_local == hash_remote
-        print(f"{module} is up to date")
-    except AssertionError:
-        print(f"Caching {module}")
-        with open(module_path, 'wb') as fout:
-            reponse = requests.get(url)
-            fout.write(reponse.content)
-    
-# Cache first, load later..
-for module in modules.keys():
-    # Finally load the module and inform the user
-    module_path = Path(cachedir/module)
-    cmd.run(str(module_path.absolute()))
-    print(f"Loaded {module}")
-    
+        with open(cachedir/"manifest.json") as fin:
+            return json.load(fin)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_manifest(cachedir: Path, manifest):
+    write_atomic(cachedir/"manifest.json", json.dumps(manifest, indent=1, sort_keys=True).encode())
+
+
+def local_hash(module_path: Path, manifest):
+    "git hash of a cached module, only hashed again when its size or mtime changed"
+    stat = module_path.stat()
+    entry = manifest.get(module_path.name)
+    if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        return entry['sha']
+    hash_local = blob_hash(module_path)
+    manifest[module_path.name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                                  'sha': hash_local}
+    return hash_local
+
+
+def fetch_module(session, url, module_path: Path):
+    response = session.get(url, timeout=timeout)
+    response.raise_for_status()
+    write_atomic(module_path, response.content)
+
+
+def update_modules(session, modules, cachedir: Path, workers=8):
+    """
+    Download the modules that changed, concurrently over one session
+    return: the modules that were downloaded
+    """
+    manifest = read_manifest(cachedir)
+    previous = dict(manifest)
+    changed = []
+    for module, (url, hash_remote) in modules.items():
+        module_path = cachedir/module
+        if module_path.exists() and local_hash(module_path, manifest) == hash_remote:
+            print(f"{module} is up to date")
+            continue
+        changed.append(module)
+
+    fetched = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {module: pool.submit(fetch_module, session, modules[module][0], cachedir/module)
+                   for module in changed}
+        for module, future in futures.items():
+            try:
+                future.result()
+            except requests.RequestException as e:
+                print(f"Could not cache {module}: {e}")
+                continue
+            print(f"Cached {module}")
+            fetched.append(module)
+            manifest.pop(module, None)
+            local_hash(cachedir/module, manifest)
+    # Forget modules that are no longer in the repo
+    manifest = {module: entry for module, entry in manifest.items() if module in modules}
+    if manifest != previous:
+        write_manifest(cachedir, manifest)
+    return fetched
+
+
+def load_modules(modules, cachedir: Path):
+    # Cache first, load later..
+    for module in modules:
+        if module in libraries: continue
+        module_path = cachedir/module
+        if not module_path.exists(): continue
+        # Finally load the module and inform the user
+        cmd.run(str(module_path.absolute()))
+        print(f"Loaded {module}")
+
+
+def is_cmd(node, attr):
+    "node is cmd.<attr>"
+    return (isinstance(node, ast.Attribute) and node.attr == attr
+            and isinstance(node.value, ast.Name) and node.value.id == "cmd")
+
+
+def index_module(module_path: Path):
+    """
+    Commands of a module from its source, without running it
+    return: command -> function name, docstring and the auto_arg
+            completions that don't need the module (selection_sc, object_sc)
+    """
+    tree = ast.parse(module_path.read_text())
+    functions = {node.name: node for node in tree.body if isinstance(node, ast.FunctionDef)}
+    names = {}   # function -> command
+    module_doc = set()   # functions with func.__doc__ = __doc__
+    auto_args = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and is_cmd(node.func, "extend"):
+            args = node.args
+            if len(args) == 2 and isinstance(args[0], ast.Constant) and isinstance(args[1], ast.Name):
+                names[args[1].id] = args[0].value
+            elif len(args) == 1 and isinstance(args[0], ast.Name):
+                names[args[0].id] = args[0].id
+        elif isinstance(node, ast.FunctionDef):
+            if any(is_cmd(decorator, "extend") for decorator in node.decorator_list):
+                names[node.name] = node.name
+        elif isinstance(node, ast.Assign) and len(node.targets) == 1:
+            target, value = node.targets[0], node.value
+            if (isinstance(target, ast.Attribute) and target.attr == "__doc__"
+                    and isinstance(target.value, ast.Name)
+                    and isinstance(value, ast.Name) and value.id == "__doc__"):
+                module_doc.add(target.value.id)
+            elif (isinstance(target, ast.Subscript) and isinstance(target.value, ast.Subscript)
+                    and is_cmd(target.value.value, "auto_arg") and isinstance(value, ast.List)):
+                auto_args.append((target, value))
+
+    commands = {}
+    for function, name in names.items():
+        if function in module_doc:
+            doc = ast.get_docstring(tree, clean=False)
+        elif function in functions:
+            doc = ast.get_docstring(functions[function], clean=False)
+        else:
+            doc = None
+        commands[name] = {'function': function, 'doc': doc, 'auto_arg': []}
+    for target, value in auto_args:
+        try:
+            i = ast.literal_eval(target.value.slice)
+            key = target.slice
+            name = key.value if isinstance(key, ast.Constant) else names.get(getattr(key, 'id', None))
+            completion, label, postfix = value.elts
+            label, postfix = ast.literal_eval(label), ast.literal_eval(postfix)
+        except ValueError:
+            continue
+        if name not in commands:
+            continue
+        if isinstance(completion, ast.Constant) and completion.value == '':
+            completion = ''
+        elif is_cmd(completion, "selection_sc") or is_cmd(completion, "object_sc"):
+            completion = completion.attr
+        else:
+            # Made by the module itself when it is imported
+            continue
+        commands[name]['auto_arg'].append([i, completion, label, postfix])
+    return commands
+
+
+def update_index(modules, cachedir: Path):
+    """
+    Commands of every module, stored in commands.json and
+    only parsed again when the module changed
+    """
+    manifest = read_manifest(cachedir)
+    previous = dict(manifest)
+    try:
+        with open(cachedir/"commands.json") as fin:
+            index = json.load(fin)
+    except (FileNotFoundError, ValueError):
+        index = {}
+    fresh = {}
+    for module in modules:
+        module_path = cachedir/module
+        if not module_path.exists(): continue
+        hash_local = local_hash(module_path, manifest)
+        entry = index.get(module)
+        if entry is None or entry['sha'] != hash_local:
+            entry = {'sha': hash_local, 'commands': index_module(module_path)}
+        fresh[module] = entry
+    if fresh != index:
+        write_atomic(cachedir/"commands.json", json.dumps(fresh, indent=1).encode())
+    if manifest != previous:
+        write_manifest(cachedir, manifest)
+    return fresh
+
+
+def takes_keyword(function, keyword):
+    "function accepts keyword, by name or through **kwargs"
+    try:
+        parameters = inspect.signature(function).parameters.values()
+    except (TypeError, ValueError):
+        return True
+    return any(p.name == keyword or p.kind == p.VAR_KEYWORD for p in parameters)
+
+
+def make_stub(name, module, function):
+    "command that imports its module on first use and then hands over to it"
+    def stub(*args, **kwargs):
+        real = getattr(importlib.import_module(module), function)
+        if cmd.keyword[name][0] is stub:
+            # Already imported before the stubs were made
+            cmd.extend(name, real)
+        # The parser passes _self because the stub takes **kwargs
+        if '_self' in kwargs and not takes_keyword(real, '_self'):
+            del kwargs['_self']
+        return real(*args, **kwargs)
+    return stub
+
+
+def register_stubs(index, cachedir: Path):
+    "Register every indexed command without running its module"
+    if str(cachedir) not in sys.path:
+        sys.path.append(str(cachedir))
+    for module, entry in index.items():
+        for name, command in entry['commands'].items():
+            stub = make_stub(name, Path(module).stem, command['function'])
+            stub.__doc__ = command['doc']
+            cmd.extend(name, stub)
+            for i, completion, label, postfix in command['auto_arg']:
+                if i < len(cmd.auto_arg):
+                    completion = getattr(cmd, completion) if completion else ''
+                    cmd.auto_arg[i][name] = [completion, label, postfix]
+
+
+def main(cachedir: Path = Path.home()/"mjtadema_pymol_cache", lazy=True):
+    start = time.perf_counter()
+    cachedir.mkdir(exist_ok=True)
+    with make_session() as session:
+        modules = list_modules(get_listing(session, cachedir))
+        listed = time.perf_counter()
+        update_modules(session, modules, cachedir)
+    updated = time.perf_counter()
+    if lazy:
+        # Modules are imported when one of their commands is first used
+        register_stubs(update_index(modules, cachedir), cachedir)
+    else:
+        load_modules(modules, cachedir)
+    loaded = time.perf_counter()
+    print(f"Started in {loaded - start:.2f} s (list {listed - start:.2f} s, "
+          f"update {updated - listed:.2f} s, load {loaded - updated:.2f} s)")
+
+
+# Run by pymol, the tests import it
+if __name__ != "loader":
+    main()
@@ -1,6 +1,12 @@
 """
 DESCRIPTION
     Merge chains back into a common object
+    Chains are merged into the object one by one, freeing each chain
+    object as it goes. Chains from split_chains come back in the order
+    they were split in, otherwise the merged object is sorted.
+    Only the order of the chains is kept, not the order of the atoms:
+    waters and ligands that followed all chains in the original object
+    come back with their own chain.
 
 ARGUMENTS
     name: base name of the original object
@@ -14,15 +20,64 @@ SEE ALSO
 """
 
 author = "Matthijs J. Tadema, MSc (2020)"
-version = 20201214
+version = 20261018
 
 from pymol import cmd
+from fnmatch import fnmatch
+from pathlib import Path
+# Bit of a janky solution but have to inject the cache directory here...
+import sys
+cachedir = Path.home()/"mjtadema_pymol_cache"
+sys.path.append(str(cachedir.absolute()))
+from bulk_edit import bulk_edit
+import chain_store
+import session_cache
 
-def merge_chains(obj):
+def merge_create(obj):
+    "Copy all chains at once, for a pymol without copy_to, needs twice the memory"
+    for name in chain_store.pending_names(obj+"_"):
+        chain_store.materialize(name)
     cmd.create('_tmp', f"{obj}_*")
     cmd.delete(f"{obj}_*")
     cmd.set_name('_tmp', obj) 
-    cmd.center(obj)
 
-cmd.extend('merge_chains', merge_chains)
 
+def merge_objects(obj, children):
+    """
+    Merge chain objects into obj one chain at a time
+    The first chain becomes obj, the others are copied into it and deleted,
+    so at most one chain is held twice. Pending chains are loaded just before.
+    """
+    for name in children:
+        chain_store.materialize(name)
+        if name == children[0]:
+            cmd.set_name(name, obj)
+        else:
+            cmd.copy_to(obj, name, rename='')
+            cmd.delete(name)
+
+
+def merge_chains(obj):
+    children = chain_store.pending_names(obj+"_")
+    children += [name for name in cmd.get_names('objects') if fnmatch(name, f"{obj}_*")]
+    if not children:
+        raise ValueError(f"No chain objects to merge for {obj}")
+    order = chain_store.order.pop(obj, None)
+    # The split order only holds if the same chains came back
+    in_order = order is not None and sorted(order) == sorted(children)
+    # Atoms keep their place within a chain, not across chains
+    if in_order:
+        children = order
+    with bulk_edit() as edit:
+        if hasattr(cmd, 'copy_to'):
+            merge_objects(obj, children)
+            if not in_order:
+                edit.sort(obj)
+        else:
+            merge_create(obj)
+        edit.center(obj)
+    for name in children + [obj]:
+        session_cache.invalidate(name)
+
+merge_chains.__doc__ = __doc__
+cmd.extend('merge_chains', merge_chains)
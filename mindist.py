@@ -15,106 +15,192 @@ ARGUMENTS
     n           : number of distances to calculate (default: 1)
     t           : threshold of number of atoms if using non-numpy calculation (default: 500)
     unique      : only one distance per residue (default: 0 (0=no, 1=yes))
+    method      : numpy search engine, "grid" (cell list), "chunked" (tiled top-n) or "full" (distance matrix) (default: grid)
+    cutoff      : initial search radius in Angstrom beyond the gap between the selections,
+                  widened until enough pairs are found (default: 5)
+    mem         : memory budget of the chunked and trajectory engines in MB (default: 256)
+    states      : trajectory mode, state range as start:stop or "all"; one minimum distance per state, no distance objects
+    stride      : use every stride-th state in trajectory mode (default: 1)
+    out         : write the trajectory time series to a .csv or .npy file
+    output      : "objects" (one distance object per pair), "single" (one distance object)
+                  or "cgo" (one line set, made in a single call) (default: objects)
+    name        : object name for the single and cgo outputs (default: mindist)
+    label       : label the cgo lines with their distance, as text in the cgo (default: 0)
 
 EXAMPLE
     mindist chain A, chain D
     mindist chain A, chain D, n=10, unique=1
+    mindist chain A, chain D, n=10, method=chunked, mem=64
+    mindist chain A, chain D, states=1:500, stride=5, out=contact.csv
+    mindist chain A, chain D, n=500, output=cgo, label=1
+    mindist ligand, polymer, n=5
 """
 author = "Matthijs J. Tadema, MSc (2020)"
-version = 20201213
+version = 20261018
 
 from pymol import cmd
+from pymol import cgo
+from pymol.vfont import plain
+import csv
+import itertools
+import math
+from types import SimpleNamespace
+from multiprocessing import shared_memory
+from pathlib import Path
+# Bit of a janky solution but have to inject the cache directory here...
+import sys
+cachedir = Path.home()/"mjtadema_pymol_cache"
+sys.path.append(str(cachedir.absolute()))
+import coords
 import warnings
-warnings.simplefilter('error', ResourceWarning)
 try:
     import numpy as np
 except:
+    np = None
     warnings.warn("Using mindist without numpy; limit your selections to few atoms.")
 
 
-def gen_index(selection) -> int:
-    "convert the selection to a list of unique indices"
-    model = cmd.get_model(selection)
-    for at in model.atom:
-        yield int(at.index)
+def _cell(xyz, size):
+    "integer (i, j, k) cell of a coordinate in a grid of size wide cells"
+    return (math.floor(xyz[0] / size), math.floor(xyz[1] / size), math.floor(xyz[2] / size))
 
-def gen_pairs(selection1, selection2, *, t=500) -> tuple:
-    "Exhaustively generate index pairs for all atoms in selection"
-    set_selection1 = set(list(gen_index(selection1)))
-    set_selection2 = set(list(gen_index(selection2)))
-    # Check if not selecting too many atoms
-    l1 = len(set_selection1)
-    l2 = len(set_selection2)
-    l = sum([l1, l2])
-    if l > t:
-        msg = f"Using slow (non numpy) implementation with too many atoms ({l}> {t}). Consider selecting fewer atoms or installing numpy/conda."
-        warnings.warn(msg, ResourceWarning)
-    # ensure that all pairs are unique
-    diff_selection2 = set_selection1.difference(set_selection2)
-    for i in set_selection1:
-        for j in set_selection2:
-            yield (i, j)
 
-
-def get_distances(selection1, selection2, **kwargs) -> float:
-    "Calculate distances for all atoms in selection"
-    for at1, at2 in gen_pairs(selection1, selection2, **kwargs):
-        d = float(cmd.get_distance(f"index {at1}", f"index {at2}"))
-        yield (at1, at2), d
+def gen_hash_pairs(coord_1, coord_2, cutoff):
+    """
+    Generate all pairs closer than cutoff without numpy
+    Atoms of coord_2 are bucketed in a dict of cutoff wide cells,
+    so every atom of coord_1 is only compared to its 27 neighbouring cells.
+    """
+    cells = {}
+    for j, xyz in enumerate(coord_2):
+        cells.setdefault(_cell(xyz, cutoff), []).append(j)
+    for i, xyz in enumerate(coord_1):
+        ci, cj, ck = _cell(xyz, cutoff)
+        for di, dj, dk in itertools.product((-1, 0, 1), repeat=3):
+            for j in cells.get((ci+di, cj+dj, ck+dk), ()):
+                d = math.dist(xyz, coord_2[j])
+                if d < cutoff:
+                    yield i, j, d
 
 
-def get_mindist(selection1, selection2, **kwargs):
+def get_mindist(sele_1, sele_2, t=500, cutoff=5.0):
     """
-    Terribly slow implementation.
+    Calculate distances without numpy using a spatial hash
+    Pairs are searched shell by shell, the cutoff doubles whenever
+    the pairs within it run out.
     Warn if selecting too many atoms
     t: int, threshold value
     """
-    raise NotImplementedError("Have to fix this again")
-    all_distances = {pair: d for pair, d in get_distances(selection1, selection2, **kwargs)}    
-    sortkey = lambda x: all_distances[x]
-    min_pairs = sorted(all_distances.keys(), key=sortkey)
-    for min_pair in min_pairs:
-        yield min_pair
+    coord_1 = sele_1.coord
+    coord_2 = sele_2.coord
+    # Check if not selecting too many atoms
+    l = len(coord_1) + len(coord_2)
+    if l > t:
+        msg = f"Using slow (non numpy) implementation with too many atoms ({l}> {t}). Consider selecting fewer atoms or installing numpy/conda."
+        warnings.warn(msg, ResourceWarning)
+    if len(coord_1) == 0 or len(coord_2) == 0:
+        return
+    # Once the cutoff exceeds the bounding box diagonal every pair has been seen
+    both = list(coord_1) + list(coord_2)
+    extent = math.dist([min(xyz[k] for xyz in both) for k in range(3)],
+                       [max(xyz[k] for xyz in both) for k in range(3)])
+    cutoff = float(cutoff)
+    lower = 0.0
+    while True:
+        # Pairs below the previous cutoff were already yielded
+        shell = sorted((d, i, j) for i, j, d in gen_hash_pairs(coord_1, coord_2, cutoff) if d >= lower)
+        for d, i, j in shell:
+            yield (i, j)
+        if cutoff > extent:
+            return
+        lower = cutoff
+        cutoff *= 2
 
 
 class Selection:
     """
-    Generate indices and an object name 
+    Generate indices and object names
+    Atom objects, indices, chains, residues and coordinates are kept as parallel arrays,
+    so positions from the distance search map to atoms without pymol calls.
+    A selection can span any number of objects, atoms are keyed by (object, index).
     """
-    def __init__(self, sele_str):
+    def __init__(self, sele_str, state=-1):
         """
         Make a sele_str object to keep some stuff together
         """
-        index = []
-        coord = []
-        obj = cmd.get_object_list(sele_str)
-        if len(obj) != 1:
-            raise NotImplementedError("Selection should be in a single object")
-        for at in cmd.get_model(sele_str).atom:
-            x, y, z = [float(n) for n in at.coord]
-            coord.append((x, y, z))
-            index.append(int(at.index))
-        self.index = index
-        self.coord = coord
-        self.obj = obj[0]
+        # One pass over the atoms instead of a model build per lookup,
+        # reused from the session cache while the atoms are unchanged
+        fields = coords.cached_fields(sele_str, "model", "index", "chain", "resi", state=state)
+        if not len(fields['index']):
+            raise ValueError(f"Selection {sele_str} contains no atoms")
+        self.sele_str = sele_str
+        # Rows into the full selection, to line up coordinates of other states
+        self.rows = list(range(len(fields['index'])))
+        self.model = fields['model']
+        self.index = fields['index']
+        self.chain = fields['chain']
+        self.resi = fields['resi']
+        self.coord = coords.get_coords(sele_str, state)
+        self.objects = list(dict.fromkeys(self.model))
+
+    def key(self, pos):
+        "Atom key (object, index) of the atom at pos"
+        return (self.model[pos], self.index[pos])
+
+    def atom(self, pos):
+        "Selection string of the atom at pos"
+        return f"{self.model[pos]} and index {self.index[pos]}"
+
+    def select(self, name, positions):
+        "Store the atoms at positions as a selection, one index list per object"
+        per_object = {}
+        for pos in positions:
+            per_object.setdefault(str(self.model[pos]), []).append(int(self.index[pos]))
+        cmd.select(name, "none")
+        for obj, index in per_object.items():
+            cmd.select_list(f"{name}_part", obj, index, mode='index')
+            cmd.select(name, f"{name} or {name}_part")
+        cmd.delete(f"{name}_part")
+
+    def residue(self, pos):
+        "Residue key (object, chain, resi) of the atom at pos"
+        return (self.model[pos], self.chain[pos], self.resi[pos])
+
+    def take(self, keep):
+        "Keep only the atoms at the positions in keep"
+        for name in ('rows', 'model', 'index', 'chain', 'resi', 'coord'):
+            values = getattr(self, name)
+            if np is not None and isinstance(values, np.ndarray):
+                values = values[np.asarray(keep, dtype=np.int64)]
+            else:
+                values = [values[k] for k in keep]
+            setattr(self, name, values)
+
+    def trajectory(self, states):
+        "Stacked coordinates of the selection, shape (states, atoms, 3)"
+        frames = []
+        for state in states:
+            coords = cmd.get_coords(self.sele_str, state)
+            if coords is None:
+                raise ValueError(f"No coordinates for {self.sele_str} in state {state}")
+            frames.append(coords)
+        return np.stack(frames)[:, self.rows]
 
     def remove_dupes(self, sele):
         """
-        Remove duplicates 
+        Remove atoms that are also in sele
         """
-        tmp = []
         # if the objects are different, there are no duplicates
-        if self.obj != sele.obj:
+        if not set(self.objects).intersection(sele.objects):
             return
-        for i in self.index:
-            if not i in sele.index:
-                tmp.append(i)
-        self.index = tmp
+        seen = set(zip(sele.model, sele.index))
+        self.take([k for k, key in enumerate(zip(self.model, self.index)) if key not in seen])
 
 
 def get_mindist_np(sele_1, sele_2):
     """
     Calculate distances using numpy
+    yields: position pairs into sele_1 and sele_2, shortest first
     """
     # Calculate distance matrix
     coord_1 = np.array(sele_1.coord)
@@ -127,32 +213,366 @@ def get_mindist_np(sele_1, sele_2):
     for idx in sort_index:
         # Min indices unraveled
         idx1, idx2 = np.unravel_index(idx, np.shape(dm))
-        # Back to atom indices
-        min_pair = (sele_1.index[idx1], sele_2.index[idx2])
-        yield min_pair
+        yield (int(idx1), int(idx2))
+
+
+def _cell_keys(cells, shape):
+    "Flatten integer (i, j, k) cell coordinates into a single key"
+    return (cells[:, 0] * shape[1] + cells[:, 1]) * shape[2] + cells[:, 2]
+
+
+def gen_grid_pairs(coord_1, coord_2, cutoff, lower=0.0, chunk=2**18):
+    """
+    Generate all pairs closer than cutoff using a uniform grid (cell list)
+    Cells are cutoff wide, so only the 27 neighbouring cells are searched.
+    lower: skip pairs closer than this, they were found before
+    chunk: candidate pairs checked at once, bounds the memory of large cells
+    yields: arrays of positions in coord_1 and coord_2 and their distances
+    """
+    origin = np.minimum(coord_1.min(axis=0), coord_2.min(axis=0))
+    # Pad one cell on every side so neighbour offsets never wrap around
+    cells_1 = np.floor((coord_1 - origin) / cutoff).astype(np.int64) + 1
+    cells_2 = np.floor((coord_2 - origin) / cutoff).astype(np.int64) + 1
+    shape = np.maximum(cells_1.max(axis=0), cells_2.max(axis=0)) + 2
+    # Sort the second selection by cell so every cell is a contiguous block
+    keys_2 = _cell_keys(cells_2, shape)
+    order = np.argsort(keys_2, kind='stable')
+    sorted_keys = keys_2[order]
+    pos_1 = np.arange(len(coord_1))
+    # One neighbour offset at a time keeps memory linear in the atom count
+    for offset in itertools.product((-1, 0, 1), repeat=3):
+        keys_1 = _cell_keys(cells_1 + offset, shape)
+        start = np.searchsorted(sorted_keys, keys_1, side='left')
+        end = np.searchsorted(sorted_keys, keys_1, side='right')
+        counts = end - start
+        ends = np.cumsum(counts)
+        total = int(ends[-1])
+        if total == 0:
+            continue
+        # Atoms of coord_1 in blocks of about chunk candidate pairs
+        splits = np.searchsorted(ends, np.arange(chunk, total, chunk), side='right')
+        for a, b in zip([0, *splits], [*splits, len(pos_1)]):
+            block = counts[a:b]
+            n_block = int(block.sum())
+            if n_block == 0:
+                continue
+            i = np.repeat(pos_1[a:b], block)
+            # Position of each pair within its block of the sorted array
+            within = np.arange(n_block) - np.repeat(np.cumsum(block) - block, block)
+            j = order[np.repeat(start[a:b], block) + within]
+            d = np.linalg.norm(coord_1[i] - coord_2[j], axis=1)
+            close = (d < cutoff) & (d >= lower)
+            yield i[close], j[close], d[close]
+
+
+def get_mindist_grid(sele_1, sele_2, cutoff=5.0):
+    """
+    Calculate distances using a cell list
+    Pairs are yielded shortest first, one shell of distances at a time.
+    The first shell starts at the gap between the bounding boxes, so
+    selections far apart don't collect every pair up to that gap.
+    Every next shell is twice as wide as the one before.
+    """
+    coord_1 = np.array(sele_1.coord, dtype=float)
+    coord_2 = np.array(sele_2.coord, dtype=float)
+    if len(coord_1) == 0 or len(coord_2) == 0:
+        return
+    low_1, high_1 = coord_1.min(axis=0), coord_1.max(axis=0)
+    low_2, high_2 = coord_2.min(axis=0), coord_2.max(axis=0)
+    # No pair is closer than the gap between the bounding boxes
+    gap = np.linalg.norm(np.maximum(0, np.maximum(low_1 - high_2, low_2 - high_1)))
+    # Once the cutoff exceeds the bounding box diagonal every pair has been seen
+    extent = np.linalg.norm(np.maximum(high_1, high_2) - np.minimum(low_1, low_2))
+    width = float(cutoff)
+    lower = 0.0
+    cutoff = gap + width
+    while True:
+        found = list(gen_grid_pairs(coord_1, coord_2, cutoff, lower))
+        if found:
+            i, j, d = [np.concatenate(arrays) for arrays in zip(*found)]
+            for k in np.argsort(d, kind='stable'):
+                yield (int(i[k]), int(j[k]))
+        if cutoff > extent:
+            return
+        width *= 2
+        lower, cutoff = cutoff, cutoff + width
+
+
+def _smallest(d, k, flat=None):
+    """
+    Positions of the k smallest values of d, ties broken by flat
+    (or by position), so the same pairs are found every time
+    """
+    if d.size <= k:
+        return np.arange(d.size)
+    v = d[np.argpartition(d, k-1)[k-1]]
+    below = np.flatnonzero(d < v)
+    tie = np.flatnonzero(d == v)
+    if flat is not None:
+        tie = tie[np.argsort(flat[tie], kind='stable')]
+    return np.concatenate([below, tie[:k - len(below)]])
+
+
+def _top_k_pairs(coord_1, coord_2, k, rows, after=None):
+    """
+    Find the k closest pairs, walking coord_1 in tiles of rows atoms
+    after: (squared distance, flat index) of the last pair found before,
+           only pairs after it in (distance, index) order are searched
+    return: squared distances and flat pair indices (unsorted)
+    """
+    m = len(coord_2)
+    sq_2 = np.einsum('ij,ij->i', coord_2, coord_2)
+    best_d = np.empty(0)
+    best_flat = np.empty(0, dtype=np.int64)
+    for start in range(0, len(coord_1), rows):
+        tile = coord_1[start:start+rows]
+        # |a - b|^2 = |a|^2 + |b|^2 - 2ab avoids the (rows, m, 3) difference tensor
+        d2 = np.einsum('ij,ij->i', tile, tile)[:, None] + sq_2[None, :] - 2 * (tile @ coord_2.T)
+        d2 = d2.ravel()
+        if after is not None:
+            # The tiles are the same every round, so the distances compare exactly
+            d_last, flat_last = after
+            d2[d2 < d_last] = np.inf
+            tie = np.flatnonzero(d2 == d_last)
+            d2[tie[tie + start*m <= flat_last]] = np.inf
+        part = _smallest(d2, k)
+        # Merge the tile's best with the running best and cut back to k
+        cand_d = np.concatenate([best_d, d2[part]])
+        cand_flat = np.concatenate([best_flat, part + start*m])
+        keep = _smallest(cand_d, k, cand_flat)
+        best_d, best_flat = cand_d[keep], cand_flat[keep]
+    left = np.isfinite(best_d)
+    return best_d[left], best_flat[left]
+
+
+def get_mindist_chunked(sele_1, sele_2, n=1, mem=256):
+    """
+    Calculate distances tile by tile within a memory budget
+    Only the n closest pairs are kept and sorted. If the caller asks for
+    more (e.g. unique=1 skipped some), the next round searches the pairs
+    after the last one yielded, with twice as many kept up to the budget.
+    Every round walks all tiles again, nothing but the last pair is kept
+    between rounds.
+    mem: memory budget in MB, half for a tile and half for the kept pairs
+    """
+    coord_1 = np.array(sele_1.coord, dtype=float)
+    coord_2 = np.array(sele_2.coord, dtype=float)
+    total = len(coord_1) * len(coord_2)
+    if total == 0:
+        return
+    budget = float(mem) * 2**20 / 2
+    # A tile row costs about four float64 arrays of len(coord_2)
+    rows = max(1, int(budget // (len(coord_2) * 8 * 4)))
+    # A kept pair costs about eight 8 byte values while merging tiles
+    k_max = max(1, int(budget // 64))
+    k = min(max(int(n), 1), k_max)
+    after = None
+    while True:
+        d2, flat = _top_k_pairs(coord_1, coord_2, k, rows, after)
+        if len(d2) == 0:
+            return
+        order = np.lexsort((flat, d2))
+        for idx in order:
+            yield divmod(int(flat[idx]), len(coord_2))
+        last = order[-1]
+        after = (d2[last], flat[last])
+        k = min(2 * k, k_max)
+
+
+def get_contacts_shared(shm_name, shape, range_1, range_2, cutoff=4.0):
+    """
+    Closest pair and contacts between two row ranges of a shared coordinate array
+    Runs in the worker processes of interface_matrix.
+    return: distance, closest position pair and contact position pairs,
+            positions relative to the whole array
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        coord = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        coord_1 = np.array(coord[range_1[0]:range_1[1]])
+        coord_2 = np.array(coord[range_2[0]:range_2[1]])
+        del coord # release the shared buffer before closing
+    finally:
+        shm.close()
+    found = list(gen_grid_pairs(coord_1, coord_2, cutoff)) if len(coord_1) and len(coord_2) else []
+    i, j, d = [np.concatenate(arrays) for arrays in zip(*found)] if found else [np.empty(0)]*3
+    if len(d):
+        k = np.argmin(d)
+        closest, dmin = (int(i[k]), int(j[k])), float(d[k])
+    else:
+        # No contacts, widen the search until the closest pair turns up
+        closest = next(get_mindist_grid(SimpleNamespace(coord=coord_1), SimpleNamespace(coord=coord_2), cutoff=cutoff), None)
+        if closest is None:
+            return float('nan'), None, []
+        dmin = float(np.linalg.norm(coord_1[closest[0]] - coord_2[closest[1]]))
+    contacts = [(int(a) + range_1[0], int(b) + range_2[0]) for a, b in zip(i, j)]
+    closest = (closest[0] + range_1[0], closest[1] + range_2[0])
+    return dmin, closest, contacts
+
+
+def get_mindist_traj(traj_1, traj_2, mem=256):
+    """
+    Calculate the minimum distance for every frame at once
+    traj_1, traj_2: coordinates with shape (frames, atoms, 3)
+    mem: memory budget in MB
+    return: distance and position pair per frame
+    """
+    frames, n_1, _ = traj_1.shape
+    n_2 = traj_2.shape[1]
+    sq_2 = np.einsum('fij,fij->fi', traj_2, traj_2)
+    best_d = np.full(frames, np.inf)
+    best_i = np.zeros(frames, dtype=np.int64)
+    best_j = np.zeros(frames, dtype=np.int64)
+    # A tile row costs about three float64 arrays of (frames, n_2)
+    rows = max(1, int(float(mem) * 2**20 // (frames * n_2 * 8 * 3)))
+    for start in range(0, n_1, rows):
+        tile = traj_1[:, start:start+rows]
+        d2 = (np.einsum('fij,fij->fi', tile, tile)[:, :, None] + sq_2[:, None, :]
+              - 2 * np.matmul(tile, traj_2.transpose(0, 2, 1)))
+        d2 = d2.reshape(frames, -1)
+        flat = d2.argmin(axis=1)
+        d = d2[np.arange(frames), flat]
+        better = d < best_d
+        i, j = np.divmod(flat, n_2)
+        best_d[better] = d[better]
+        best_i[better] = start + i[better]
+        best_j[better] = j[better]
+    return np.sqrt(np.maximum(best_d, 0)), best_i, best_j
+
+
+def write_timeseries(out, states, dist, sele_1, pos_1, sele_2, pos_2):
+    "Write the per state minimum distances to a .csv or .npy file"
+    if str(out).endswith(".npy"):
+        series = np.zeros(len(states), dtype=[
+            ('state', 'i4'), ('distance', 'f8'),
+            ('object_1', 'U64'), ('index_1', 'i8'),
+            ('object_2', 'U64'), ('index_2', 'i8')])
+        series['state'] = states
+        series['distance'] = dist
+        series['object_1'] = [sele_1.model[i] for i in pos_1]
+        series['index_1'] = [sele_1.index[i] for i in pos_1]
+        series['object_2'] = [sele_2.model[j] for j in pos_2]
+        series['index_2'] = [sele_2.index[j] for j in pos_2]
+        np.save(out, series)
+        return
+    with open(out, 'w', newline='') as fout:
+        writer = csv.writer(fout)
+        writer.writerow(["state", "distance", "object_1", "index_1", "object_2", "index_2"])
+        for state, d, i, j in zip(states, dist, pos_1, pos_2):
+            writer.writerow([state, f"{d:.3f}", *sele_1.key(i), *sele_2.key(j)])
+
+
+def mindist_states(sele_1, sele_2, states, mem=256, out=None):
+    """
+    Minimum distance over a range of states, without distance objects
+    return: states, distances and position pairs
+    """
+    traj_1 = sele_1.trajectory(states)
+    traj_2 = sele_2.trajectory(states)
+    dist, pos_1, pos_2 = get_mindist_traj(traj_1, traj_2, mem=mem)
+    if out is not None:
+        write_timeseries(out, states, dist, sele_1, pos_1, sele_2, pos_2)
+        print(f"Wrote {len(states)} states to {out}")
+    else:
+        for state, d, i, j in zip(states, dist, pos_1, pos_2):
+            print(f"state {state}: {d:.3f} ({sele_1.atom(i)}, {sele_2.atom(j)})")
+    return states, dist, pos_1, pos_2
 
 
 def idx_to_resi(idx: int) -> int:
     "Get the residue number corresponding to the atom index"
-    model = cmd.get_model(f"index {idx}")
-    resi = model.atom[0].resi
+    resi = coords.get_fields(f"index {idx}", "resi")['resi'][0]
     resi = int(resi)
     return resi
 ir = idx_to_resi # abbrev
     
 
-def mindist(selection1, selection2, n=1, t=500, unique=0, _legacy=0):
+def draw_objects(pairs, sele_1, sele_2):
+    "One distance object per pair"
+    # Atom indices alone are ambiguous once a selection spans several objects
+    named = len(sele_1.objects) > 1 or len(sele_2.objects) > 1
+    for i, j in pairs:
+        a, b = sele_1.index[i], sele_2.index[j]
+        if named:
+            a, b = f"{sele_1.model[i]}_{a}", f"{sele_2.model[j]}_{b}"
+        cmd.distance(f"mindist_{a}_{b}", sele_1.atom(i), sele_2.atom(j))
+
+
+def draw_single(pairs, sele_1, sele_2, name="mindist", unique=0):
+    """
+    All pairs in one distance object
+    Without unique, the pairs are exactly those between their atoms up to
+    the longest pair, so one distance call between the atoms draws them.
+    With unique=1 that call would also draw the pairs the filter skipped,
+    so every pair is added to the object on its own.
+    """
+    cmd.delete(name)
+    if not pairs:
+        return
+    if int(unique) == 1:
+        for i, j in pairs:
+            cmd.distance(name, sele_1.atom(i), sele_2.atom(j))
+        return
+    pos_1, pos_2 = zip(*pairs)
+    longest = max(math.dist(sele_1.coord[i], sele_2.coord[j]) for i, j in pairs)
+    sele_1.select(f"_{name}_1", pos_1)
+    sele_2.select(f"_{name}_2", pos_2)
+    cmd.distance(name, f"_{name}_1", f"_{name}_2", cutoff=longest + 1e-3, mode=0)
+    cmd.delete(f"_{name}_1")
+    cmd.delete(f"_{name}_2")
+
+
+def draw_cgo(pairs, sele_1, sele_2, name="mindist", label=0):
+    """
+    All pairs as one cgo line set, from the coordinates we already have
+    Labels are vector text in the same cgo, at the midpoints and facing
+    the current view, so they don't add atoms to the session.
+    """
+    color = [1.0, 1.0, 0.0]
+    obj = [cgo.BEGIN, cgo.LINES, cgo.COLOR, *color]
+    for i, j in pairs:
+        obj += [cgo.VERTEX, *sele_1.coord[i], cgo.VERTEX, *sele_2.coord[j]]
+    obj.append(cgo.END)
+    if int(label) == 1:
+        # Rows of the view rotation are the camera axes in model space
+        view = cmd.get_view()
+        axes = [list(view[k:9:3]) for k in range(3)]
+        for i, j in pairs:
+            xyz_1, xyz_2 = sele_1.coord[i], sele_2.coord[j]
+            middle = [(c1 + c2) / 2 for c1, c2 in zip(xyz_1, xyz_2)]
+            cgo.cyl_text(obj, plain, middle, f"{math.dist(xyz_1, xyz_2):.2f}",
+                         radius=0.05, color=color, axes=axes)
+    cmd.delete(name)
+    cmd.load_cgo(obj, name)
+
+
+def mindist(selection1, selection2, n=1, t=500, unique=0, method="grid", cutoff=5, mem=256,
+        states=None, stride=1, out=None, output="objects", name="mindist", label=0, _legacy=0):
     # Create selection objects 
     sele_1 = Selection(selection1)
     sele_2 = Selection(selection2)
     sele_2.remove_dupes(sele_1)
-    try:
-        if int(_legacy) != 0:
-            raise ImportError("Used for testing without numpy")
+    if states is not None:
+        if np is None:
+            print("Trajectory mode will not work without numpy.\nConsider installing numpy (or anaconda, provides numpy).")
+            return
+        states = coords.parse_states(states, selection1, stride)
+        return mindist_states(sele_1, sele_2, states, mem=float(mem), out=out)
+    if np is None or int(_legacy) != 0:
+        # _legacy=1 is used for testing without numpy
+        gen_mindist = get_mindist(sele_1, sele_2, t=int(t), cutoff=float(cutoff))
+    elif method == "grid":
+        gen_mindist = get_mindist_grid(sele_1, sele_2, cutoff=float(cutoff))
+    elif method == "chunked":
+        gen_mindist = get_mindist_chunked(sele_1, sele_2, n=int(n), mem=float(mem))
+    elif method == "full":
         gen_mindist = get_mindist_np(sele_1, sele_2)
-    except (NameError, ImportError, NotImplementedError):
-        gen_mindist = get_mindist(selection1, selection2, t=500)
-    resi_pairs = [] # keep track of residue pairs in case we want to skip
+    else:
+        raise ValueError(f"Unknown method {method}, use grid, chunked or full")
+    if output not in ("objects", "single", "cgo"):
+        raise ValueError(f"Unknown output {output}, use objects, single or cgo")
+    pairs = []
+    resi_pairs = set() # keep track of residue pairs in case we want to skip
     count = 0
     while count < int(n):
         try:
@@ -160,16 +580,22 @@ def mindist(selection1, selection2, n=1, t=500, unique=0, _legacy=0):
         except StopIteration:
             # it could be that < n pairs were selected
             break
-        a, b = min_pair
-        resi_pair = {ir(a), ir(b)}
-        if unique == 1 and resi_pair in resi_pairs:
+        i, j = min_pair
+        resi_pair = frozenset([sele_1.residue(i), sele_2.residue(j)])
+        if int(unique) == 1 and resi_pair in resi_pairs:
             # skip if we want only unique residues
             # distances are sorted anyway so we'll get the shortes distance
             continue
         else:
-            resi_pairs.append(resi_pair)
-        cmd.distance(f"mindist_{a}_{b}", f"index {a} and {sele_1.obj}", f"index {b} and {sele_2.obj}")
+            resi_pairs.add(resi_pair)
+        pairs.append(min_pair)
         count += 1
+    if output == "objects":
+        draw_objects(pairs, sele_1, sele_2)
+    elif output == "single":
+        draw_single(pairs, sele_1, sele_2, name=name, unique=unique)
+    else:
+        draw_cgo(pairs, sele_1, sele_2, name=name, label=label)
 
 mindist.__doc__ = __doc__
 cmd.extend('mindist', mindist)
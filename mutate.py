@@ -4,53 +4,172 @@ DESCRIPTION
     Do mutations on an entire selection at once.
     Use default rotamers (by default the lowest strain).
 
+    Rotamers are cached by residue environment, so mutating the same
+    position to the same residue again puts the earlier mutant back
+    without running the wizard.
+    See mutate_cache for cache statistics.
+
 ARGUMENTS
     selection   : selection string, all residues are mutated to the same resname
     resname     : name of the residue to mutate to, can be one or three letter code
+    cache       : reuse cached rotamers (default: 1)
 
 EXAMPLE
     mutate resi 10, ARG
     mutate resi -1, A
     mutate resi 12 and chain A, G
+    mutate resi 12, R, cache=0
+    mutate_cache
+    mutate_cache clear
 """
 author = "Matthijs J. Tadema, MSc (2020)"
-version = 20201213
+version = 20261018
 
 from pymol import cmd
+from collections import OrderedDict
+from hashlib import sha1
+from pathlib import Path
+import re
+import time
+# Bit of a janky solution but have to inject the cache directory here...
+import sys
+cachedir = Path.home()/"mjtadema_pymol_cache"
+sys.path.append(str(cachedir.absolute()))
+from bulk_edit import bulk_edit
+import coords
+import session_cache
 
 def get_resi(selection):
-    model = cmd.get_model(selection)
-    return {at.resi for at in model.atom}
+    return set(coords.get_fields(selection, "resi")['resi'])
 
 def get_chains(selection):
-    model = cmd.get_model(selection)
-    return {at.chain for at in model.atom}
+    return set(coords.get_fields(selection, "chain")['chain'])
 
 def is_one_residue(selection):
     "Check if selection is a single residue"
     objects = {*cmd.get_object_list(selection)}
+    segis = set(coords.get_fields(selection, "segi")['segi'])
     chains = get_chains(selection)
     resi = get_resi(selection)
-    return len(chains) == 1 and len(resi) == 1 and len(objects) == 1
+    return len(segis) == 1 and len(chains) == 1 and len(resi) == 1 and len(objects) == 1
+
+class RotamerCache:
+    """
+    LRU cache of mutant residues
+    Keyed by the residue environment: a hash of the residue id and the
+    atoms of other residues within radius of its CA, plus the target
+    amino acid. The residue's own backbone is left out, applying a
+    mutation moves it a little.
+    """
+    def __init__(self, maxsize=256, radius=6.0):
+        self.maxsize = maxsize
+        self.radius = radius
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, selection, aa):
+        "hash of the environment of a single residue selection"
+        env_sele = (f"byobject ({selection}) and not ({selection}) and "
+                    f"((({selection}) and name CA) around {self.radius})")
+        site = []
+        cmd.iterate(f"({selection}) and name CA", "site.append((segi, chain, resi))",
+                space={'site': site})
+        env = []
+        cmd.iterate_state(-1, env_sele,
+                "env.append((chain, resi, name, round(x, 1), round(y, 1), round(z, 1)))",
+                space={'env': env})
+        return sha1(f"{aa}{site}{sorted(env)}".encode()).hexdigest()
+
+    def get(self, key):
+        "chempy model of the mutant residue, or None"
+        model = self.entries.get(key)
+        if model is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return model
+
+    def put(self, key, model):
+        self.entries[key] = model
+        self.entries.move_to_end(key)
+        self.resize(self.maxsize)
+
+    def resize(self, maxsize):
+        "evict the least recently used rotamers beyond maxsize"
+        self.maxsize = maxsize
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+rotamer_cache = RotamerCache()
+
+def swap_residue(selection, model):
+    """
+    Put a cached mutant residue in place of a single residue selection
+    The old residue is removed, the mutant merged into its object
+    and bonded to the atoms of other residues the old one was bonded to.
+    """
+    obj = cmd.get_object_list(selection)[0]
+    outside = []
+    cmd.iterate(f"(neighbor ({selection})) and not ({selection})", "outside.append(index)",
+            space={'outside': outside})
+    # (atom of another residue, atom name in this residue) of every bond
+    bonds = []
+    for k, index in enumerate(outside):
+        names = []
+        cmd.iterate(f"({selection}) and neighbor ({obj} and index {index})",
+                "names.append(name)", space={'names': names})
+        # A named selection keeps pointing at its atom while atoms are removed and added
+        cmd.select(f"_link{k}", f"{obj} and index {index}")
+        bonds += [(f"_link{k}", name) for name in names]
+    cmd.remove(selection)
+    cmd.load_model(model, "_rotamer")
+    cmd.copy_to(obj, "_rotamer", rename='')
+    cmd.delete("_rotamer")
+    for link, name in bonds:
+        cmd.bond(link, f"({selection}) and name {name}")
+    cmd.delete("_link*")
 
-def mutate_one(selection, aa):
+
+def mutate_one(selection, aa, check=True, cache=None):
     """
     Selection must be one residue
+    check: verify that it is, skip when the residues come from iter_residues
+    cache: RotamerCache to reuse mutant residues from
     """
-    assert is_one_residue(selection)
+    if check:
+        assert is_one_residue(selection)
+    key = None
+    if cache is not None:
+        key = cache.key(selection, aa)
+        model = cache.get(key)
+        if model is not None:
+            swap_residue(selection, model)
+            print(f"Mutated {selection} to {aa} (cached rotamer)")
+            return
+    wizard = cmd.get_wizard()
     cmd.select(selection)
-    cmd.get_wizard().do_select('''sele''')
-    cmd.get_wizard().set_mode(aa)
-    cmd.get_wizard().apply()
+    wizard.do_select('''sele''')
+    wizard.set_mode(aa)
+    wizard.apply()
+    if cache is not None:
+        cache.put(key, cmd.get_model(selection))
     print(f"Mutated {selection} to {aa}")
         
 def iter_residues(selection):
     "return selection string for a single residue"
-    objects = cmd.get_object_list(selection)
-    for obj in objects:
-        for chain in get_chains(f"{selection} and {obj}"):
-            for resi in get_resi(f"{selection} and {obj}"):
-                yield f"resi {resi} and chain {chain} and {obj}"
+    # One pass over the atoms, only residues that actually exist
+    residues = []
+    cmd.iterate(selection, "residues.append((model, segi, chain, resi))", space={'residues': residues})
+    for obj, segi, chain, resi in dict.fromkeys(residues):
+        # Quoted, so blank chain and segment identifiers select too
+        yield f'resi {resi} and chain "{chain}" and segi "{segi}" and {obj}'
 
 aminos = { 
     'A': "ALA",    'C': "CYS",
@@ -79,19 +198,94 @@ def fix_aa(aa):
         one or three letter, was {aa}""")
     return aa
 
-def mutate(selection, aa):
+# Headless pymol of a mutate_scan worker process
+_scan = {}
+
+def scan_init(path, obj):
+    "Start a headless pymol in a worker process and load the structure once"
+    from pymol2 import PyMOL
+    pymol = PyMOL()
+    pymol.start()
+    pymol.cmd.load(path, obj)
+    pymol.cmd.wizard("mutagenesis")
+    pymol.cmd.refresh_wizard()
+    _scan.update(pymol=pymol, path=path, obj=obj)
+
+def scan_one(residue, aa, save_dir=None):
+    """
+    Score the rotamers of one mutation in the worker's pymol
+    save_dir: apply the lowest strain rotamer and save the mutant there
+    return: residue, aa, lowest strain, number of rotamers, saved path
+    """
+    wcmd = _scan['pymol'].cmd
+    obj = _scan['obj']
+    wizard = wcmd.get_wizard()
+    wizard.set_mode(aa)
+    # do_select deletes the selection it is given, so never pass the object itself
+    wcmd.select("sele", residue)
+    wizard.do_select("sele")
+    # One strain score per rotamer state, empty without rotamers (ALA, GLY)
+    scores = list(getattr(wizard, 'bump_scores', None) or [])
+    best = min(range(len(scores)), key=scores.__getitem__) if scores else None
+    path = None
+    if save_dir is None:
+        wizard.clear()
+    else:
+        if best is not None:
+            wcmd.frame(best + 1)
+        wizard.apply()
+        tag = re.sub(r'\W+', '_', residue)
+        path = str(Path(save_dir)/f"{tag}_{aa}.pdb")
+        wcmd.save(path, obj)
+        # Back to the original structure for the next task
+        wcmd.delete(obj)
+        wcmd.load(_scan['path'], obj)
+    strain = scores[best] if scores else None
+    return residue, aa, strain, len(scores), path
+
+def mutate(selection, aa, cache=1):
     aa = fix_aa(aa)
+    cache = rotamer_cache if int(cache) == 1 else None
+    start = time.perf_counter()
+    residues = list(iter_residues(selection))
+    objects = cmd.get_object_list(selection)
     cmd.set("retain_order", 0)
-    cmd.wizard("mutagenesis")
-    cmd.refresh_wizard()
-    for single_res in iter_residues(selection):
-        mutate_one(single_res, aa)
-    cmd.set_wizard()
-    cmd.sort()
+    with bulk_edit() as edit:
+        # One wizard session for all residues
+        cmd.wizard("mutagenesis")
+        cmd.refresh_wizard()
+        try:
+            for single_res in residues:
+                mutate_one(single_res, aa, check=False, cache=cache)
+        finally:
+            cmd.set_wizard()
+        edit.sort()
+    for obj in objects:
+        session_cache.invalidate(obj)
+    print(f"Mutated {len(residues)} residues to {aa} in {time.perf_counter() - start:.2f} s")
+
+def mutate_cache(action="stats", size=None):
+    """
+    Print the rotamer cache statistics
+    action: stats or clear
+    size: maximum number of cached rotamers
+    """
+    if size is not None:
+        rotamer_cache.resize(int(size))
+    if action == "clear":
+        rotamer_cache.clear()
+    elif action != "stats":
+        raise ValueError(f"Unknown action {action}, use stats or clear")
+    total = rotamer_cache.hits + rotamer_cache.misses
+    rate = rotamer_cache.hits / total if total else 0.0
+    print(f"Rotamer cache: {len(rotamer_cache.entries)}/{rotamer_cache.maxsize} entries, "
+          f"{rotamer_cache.hits} hits, {rotamer_cache.misses} misses ({rate:.0%} hit rate)")
 
 mutate.__doc__ = __doc__
 cmd.extend('mutate', mutate)
+cmd.extend('mutate_cache', mutate_cache)
 
 cmd.auto_arg[0]['mutate'] = [cmd.selection_sc, 'selection', '']
 amino_sc = lambda: cmd.Shortcut(list(aminos.keys())+list(aminos.values())+extra)
 cmd.auto_arg[1]['mutate'] = [amino_sc, 'amino acid', '']
+cmd.auto_arg[0]['mutate_cache'] = [lambda: cmd.Shortcut(["stats", "clear"]), 'action', '']
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+DESCRIPTION
+    Saturation mutagenesis: mutate every residue in a selection to every
+    amino acid and record the strain of the best rotamer.
+    Mutations are scored in parallel by headless pymol processes,
+    the structure itself is not changed.
+
+ARGUMENTS
+    selection   : selection string, residues to scan (single object)
+    aas         : space separated amino acids, one or three letter code (default: all 20)
+    processes   : number of worker processes (default: number of cpus)
+    out         : save the table to a .csv file
+    save        : save the models of the n lowest strain mutants (default: 0)
+    save_dir    : directory for the saved models (default: current directory)
+
+EXAMPLE
+    mutate_scan resi 10-20 and chain A
+    mutate_scan resi 12, aas=R K E D, out=scan.csv
+    mutate_scan chain A and resi 100-110, save=5, save_dir=mutants
+"""
+author = "Matthijs J. Tadema, MSc (2020)"
+version = 20261018
+
+from pymol import cmd
+import csv
+import multiprocessing
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+# Bit of a janky solution but have to inject the cache directory here...
+import sys
+cachedir = Path.home()/"mjtadema_pymol_cache"
+sys.path.append(str(cachedir.absolute()))
+from mutate import aminos, fix_aa, iter_residues, scan_init, scan_one
+
+
+def strain_key(result):
+    "sort by strain, mutations without rotamers last"
+    strain = result[2]
+    return (strain is None, strain if strain is not None else 0.0)
+
+
+def mutate_scan(selection, aas="all", processes=None, out=None, save=0, save_dir="."):
+    objects = cmd.get_object_list(selection)
+    if len(objects) != 1:
+        raise ValueError("Selection should be in a single object")
+    obj = objects[0]
+    if aas == "all":
+        aas = list(aminos.values())
+    else:
+        aas = [fix_aa(aa) for aa in aas.split()]
+    if processes is not None:
+        processes = int(processes)
+    start = time.perf_counter()
+    residues = list(iter_residues(selection))
+    tasks = [(residue, aa) for residue in residues for aa in aas]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Workers load the structure once from file
+        path = str(Path(tmp)/f"{obj}.cif")
+        cmd.save(path, obj)
+        # Fresh processes, a forked copy of a running GUI is no place for a pymol instance
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=processes, mp_context=ctx,
+                                 initializer=scan_init, initargs=(path, obj)) as pool:
+            chunksize = max(1, len(tasks) // (4 * (processes or multiprocessing.cpu_count())))
+            results = list(pool.map(scan_one, *zip(*tasks), chunksize=chunksize))
+            results.sort(key=strain_key)
+            saved = []
+            if int(save) > 0:
+                Path(save_dir).mkdir(parents=True, exist_ok=True)
+                best = results[:int(save)]
+                saved = list(pool.map(scan_one, [r[0] for r in best], [r[1] for r in best],
+                                      [str(save_dir)]*len(best)))
+
+    print(f"{'residue':<30} {'aa':<4} {'strain':>10} {'rotamers':>8}")
+    for residue, aa, strain, n_rot, _ in results:
+        strain = f"{strain:.2f}" if strain is not None else "-"
+        print(f"{residue:<30} {aa:<4} {strain:>10} {n_rot:>8}")
+    for *_, path in saved:
+        print(f"Saved {path}")
+    if out is not None:
+        with open(out, 'w', newline='') as fout:
+            writer = csv.writer(fout)
+            writer.writerow(["residue", "aa", "strain", "rotamers"])
+            for residue, aa, strain, n_rot, _ in results:
+                writer.writerow([residue, aa, "" if strain is None else f"{strain:.3f}", n_rot])
+        print(f"Saved {out}")
+    print(f"Scanned {len(tasks)} mutations in {time.perf_counter() - start:.2f} s")
+    return results
+
+mutate_scan.__doc__ = __doc__
+cmd.extend('mutate_scan', mutate_scan)
+
+cmd.auto_arg[0]['mutate_scan'] = [cmd.selection_sc, 'selection', ', ']
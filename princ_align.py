@@ -4,33 +4,163 @@ DESCRIPTION
 
 ARGUMENTS
     selection: a selection string
+    states: align every state on its own principal axes, all or start:stop
+            (default: only the current state)
+    stride: step between the states (default: 1)
+    atoms: atoms that define the axes, ca, backbone, heavy, all
+           or a selection string (default: ca)
+    weight: weigh the atoms by their mass (default: 0)
 
 EXAMPLE
     princ_align obj01
+    princ_align obj01, states=all
+    princ_align membrane, atoms=heavy, weight=1
 
 """
 author = "Matthijs J. Tadema, MSc (2020)"
-version = 20201217
+version = 20261018
 # inspired by https://github.com/pierrepo/principal_axes
 from pymol import cmd
+from collections import namedtuple
 try:
     import numpy as np
 except:
     pass
-
-
-def get_principal_axes(coords):
-    """Calculate princ axes for the selection,
-    return: ordered eigenvectors"""
-    # Should figure out what's going on here...
-    inertia = np.dot(coords.T, coords)
-    eig_val, eig_vec = np.linalg.eig(inertia)
-    # Order by largest eigenvalue
-    # Needed to be in reverse....
-    order = list(reversed(np.argsort(eig_val)))
-    eig_val = eig_val[order]
-    eig_vec = eig_vec[:, order].T
-    return eig_vec
+from pathlib import Path
+# Bit of a janky solution but have to inject the cache directory here...
+import sys
+cachedir = Path.home()/"mjtadema_pymol_cache"
+sys.path.append(str(cachedir.absolute()))
+import coords
+import session_cache
+
+
+PrincipalAxes = namedtuple("PrincipalAxes", ["center", "axes", "eigenvalues"])
+
+atom_sets = {
+    'ca': "name CA",
+    'backbone': "backbone",
+    'heavy': "not hydro",
+    'all': "all",
+}
+
+# Atomic masses of the elements found in biomolecular systems
+masses = {
+    'H': 1.008, 'C': 12.011, 'N': 14.007, 'O': 15.999, 'F': 18.998,
+    'Na': 22.990, 'Mg': 24.305, 'P': 30.974, 'S': 32.06, 'Cl': 35.45,
+    'K': 39.098, 'Ca': 40.078, 'Mn': 54.938, 'Fe': 55.845, 'Co': 58.933,
+    'Ni': 58.693, 'Cu': 63.546, 'Zn': 65.38, 'Se': 78.971, 'Br': 79.904,
+    'I': 126.904,
+}
+
+
+def atom_subset(selection, atoms="ca"):
+    "the atoms of selection that define the axes"
+    return f"({selection}) and ({atom_sets.get(str(atoms).lower(), atoms)})"
+
+
+def atom_masses(selection, state=-1):
+    "masses of the atoms in selection, lined up with get_coords"
+    elem = coords.get_fields(selection, "elem", state=state)['elem']
+    names, inverse = np.unique(elem, return_inverse=True)
+    unknown = [name for name in names if name.capitalize() not in masses]
+    if unknown:
+        raise ValueError(f"No mass for element(s) {', '.join(unknown)}")
+    return np.array([masses[name.capitalize()] for name in names])[inverse]
+
+
+def principal_axes(selection, state=-1, weight=0, chunk=100000):
+    """Principal axes of a selection from running sums of the first and
+    second moments over chunks of atoms, so memory stays constant
+    return: PrincipalAxes, the axes are rows ordered by largest eigenvalue
+            and the eigenvalues are the mean square extent along each axis"""
+    state = coords.current_state(state)
+    total, first, second, origin = 0.0, np.zeros(3), np.zeros((3, 3)), None
+    for part in coords.atom_chunks(selection, chunk):
+        xyz = cmd.get_coords(part, state)
+        if xyz is None:
+            continue
+        if origin is None:
+            # Sum around a point close to the atoms to keep the precision
+            origin = xyz.mean(axis=0)
+        xyz = xyz - origin
+        w = atom_masses(part, state) if weight else np.ones(len(xyz))
+        total += w.sum()
+        first += w @ xyz
+        second += (xyz * w[:, None]).T @ xyz
+    if origin is None:
+        raise ValueError(f"No atoms in {selection}")
+    mean = first / total
+    eig_val, eig_vec = np.linalg.eigh(second / total - np.outer(mean, mean))
+    axes = fix_signs(eig_vec[:, ::-1].T[None])[0]
+    return PrincipalAxes(origin + mean, axes, eig_val[::-1])
+
+
+def principal_axes_states(xyz, weights=None):
+    """Principal axes of every frame of a (frames, atoms, 3) array at once
+    weights: optional per atom weights
+    return: PrincipalAxes with centers (frames, 3), axes (frames, 3, 3)
+            and eigenvalues (frames, 3)"""
+    if weights is None:
+        weights = np.ones(xyz.shape[1])
+    weights = weights / weights.sum()
+    centers = np.einsum('n,fni->fi', weights, xyz)
+    centered = xyz - centers[:, None, :]
+    inertia = np.einsum('n,fni,fnj->fij', weights, centered, centered)
+    eig_val, eig_vec = np.linalg.eigh(inertia)
+    # eigh sorts ascending and puts the vectors in the columns
+    axes = eig_vec[:, :, ::-1].transpose(0, 2, 1)
+    return PrincipalAxes(centers, fix_signs(axes, centered, weights), eig_val[:, ::-1])
+
+
+def fix_signs(axes, centered=None, weights=None):
+    """Deterministic signs for a series of axes (frames, 3, 3)
+    In the first frame the largest component of an axis is positive.
+    Given the centered coordinates (frames, atoms, 3), every next frame
+    takes the flips that best overlay its atoms, in the principal frame,
+    on the frame before, so a molecule that rotates between states
+    doesn't flip. The third axis makes it right-handed"""
+    axes = axes.copy()
+    # Right-handed first, flipping the first or second axis then flips the third too
+    axes[:, 2] = np.cross(axes[:, 0], axes[:, 1])
+    first = axes[0, :2]
+    start = np.sign(first[np.arange(2), np.abs(first).argmax(axis=1)])
+    steps = np.ones((len(axes), 2))
+    if centered is not None and len(axes) > 1:
+        if weights is None:
+            weights = np.ones(centered.shape[1])
+        aligned = np.einsum('fij,fnj->fni', axes, centered)
+        # Overlap along every axis with the frame before
+        overlap = np.einsum('n,fni,fni->fi', weights, aligned[1:], aligned[:-1])
+        flips = np.array([[1, 1], [1, -1], [-1, 1], [-1, -1]])
+        score = overlap[:, :2] @ flips.T + overlap[:, 2:] * flips.prod(axis=1)
+        steps[1:] = flips[score.argmax(axis=1)]
+    # Flips between consecutive frames, accumulated from the first frame
+    signs = start * np.cumprod(steps, axis=0)
+    axes[:, :2] *= signs[:, :, None]
+    axes[:, 2] = np.cross(axes[:, 0], axes[:, 1])
+    return axes
+
+
+def align_states(selection, states, stride=1, atoms="ca", weight=0, batch=256):
+    """Align every state on the principal axes of its own atoms
+    return: PrincipalAxes of every state"""
+    subset = atom_subset(selection, atoms)
+    states = coords.parse_states(states, subset, stride)
+    weights = atom_masses(subset, states[0]) if weight else None
+    found = principal_axes_states(coords.get_states_coords(subset, states), weights)
+    centers, axes = found.center, found.axes
+    # Move the whole objects, in batches of states to bound the memory
+    target = f"byobject ({selection})"
+    for start in range(0, len(states), batch):
+        stop = start + batch
+        xyz = coords.get_states_coords(target, states[start:stop])
+        xyz -= centers[start:stop, None, :]
+        xyz = np.einsum('fij,fnj->fni', axes[start:stop], xyz)
+        for state, frame in zip(states[start:stop], xyz):
+            cmd.load_coords(frame, target, state=state)
+    cmd.center()
+    return found
 
 
 def vec_angle(v1, v2):
@@ -58,30 +188,29 @@ def rotation_matrix_from_vectors(vec1, vec2):
     return rotation_matrix
 
 
-def princ_align(selection='(all)'):
+def princ_align(selection='(all)', states=None, stride=1, atoms="ca", weight=0):
 
-    model = cmd.get_model(f"{selection} and name CA")
-    coords = np.array([at.coord for at in model.atom])
     try:
-        center = np.mean(coords, axis=0)
+        np
     except NameError:
         print("This command will not work without numpy.\nConsider installing numpy (or anaconda, provides numpy).")
         return
-    coords -= center
-
-    eig_vec = get_principal_axes(coords)
-    # Now i have to calculate angles...
-    # largest should be aligned with Z-axis
-    x0 = np.array([1, 0, 0])
-    y0 = np.array([0, 1, 0])
-    z0 = np.array([0, 0, 1])
+    weight = int(weight)
+    if states is not None:
+        return align_states(selection, states, int(stride), atoms, weight)
+    subset = atom_subset(selection, atoms)
+    # Reused while the atoms and their coordinates are unchanged
+    found = session_cache.cached(("axes", weight), subset, coords.current_state(-1),
+            lambda: principal_axes(subset, weight=weight))
+    center = found.center
 
     # Transform everything such that it is centered around
     # selection's center, and rotated
     # Such that the principal axes of the selection
-    # align with those of the frame of reference
-    # For some reason x0 is the right one to align with the z-axis
-    rot_mat = rotation_matrix_from_vectors(eig_vec[0], x0)
+    # align with those of the frame of reference:
+    # largest on x, then y, then z.
+    # The axes are the rows of a right-handed rotation, like in align_states
+    rot_mat = found.axes
     
     TTT = [
             *rot_mat[0], -center[0],
@@ -95,7 +224,7 @@ def princ_align(selection='(all)'):
     # Finally center all
     cmd.center()
 
-    return eig_vec # Just in case i need them later
+    return found # Just in case i need them later
 
 princ_align.__doc__ = __doc__
 cmd.extend('princ_align', princ_align)
@@ -0,0 +1,183 @@
+"""
+DESCRIPTION
+    Show the statistics of the session cache shared by the scripts.
+    Atom fields, residue tables and principal axes are kept per
+    (atoms, state) and reused by mindist, carve and princ_align.
+    Entries are keyed on the atoms a selection resolves to, so a redefined
+    named selection misses, and entries that depend on coordinates are only
+    served while those of their atoms are the same, so translate,
+    alter_state and princ_align are seen.
+    Entries are also dropped when their objects change (edits through these
+    scripts, a different atom or state count, or a moved object matrix) and
+    the least recently used entries are evicted beyond the memory limit.
+    Atom properties changed in place with alter are not seen, run
+    cache_stats clear after those.
+
+ARGUMENTS
+    action: stats or clear (default: stats)
+    limit: memory limit in MB
+
+EXAMPLE
+    cache_stats
+    cache_stats clear
+    cache_stats limit=1024
+"""
+author = "Matthijs J. Tadema, MSc (2020)"
+version = 20261018
+
+from pymol import cmd
+from collections import OrderedDict
+import sys
+import hashlib
+
+
+def sizeof(value):
+    "rough size in bytes of a cached value"
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sum(sizeof(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(sizeof(v) for v in value)
+    return sys.getsizeof(value)
+
+
+def freeze(value):
+    "make cached arrays read-only so callers can't change them in place"
+    if hasattr(value, 'setflags'):
+        value.setflags(write=False)
+    elif isinstance(value, dict):
+        for v in value.values():
+            freeze(v)
+    elif isinstance(value, tuple):
+        for v in value:
+            freeze(v)
+    return value
+
+
+class SessionCache:
+    """
+    LRU cache of data extracted from pymol objects
+    Every entry remembers a fingerprint of its objects and is only
+    served while the fingerprints still match.
+    """
+    def __init__(self, limit=512):
+        self.limit = limit * 2**20
+        self.entries = OrderedDict()
+        self.versions = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def fingerprint(self, obj):
+        "cheap check for changes made outside of these scripts"
+        return (self.versions.get(obj, 0), cmd.count_atoms(obj),
+                cmd.count_states(obj), tuple(cmd.get_object_matrix(obj)))
+
+    def resolve(self, selection, state, coordinates=True, chunk=100000):
+        """
+        Digest of the atoms in selection and, per object, of their
+        coordinates in state (empty without coordinates),
+        read in chunks of atoms so memory stays constant
+        """
+        atoms = hashlib.blake2b(digest_size=16)
+        xyz = {}
+        for obj in cmd.get_object_list(selection) or []:
+            digest = hashlib.blake2b(digest_size=16)
+            for start in range(1, cmd.count_atoms(obj) + 1, chunk):
+                part = f"({selection}) and model {obj} and index {start}-{start + chunk - 1}"
+                atoms.update(repr(cmd.index(part)).encode())
+                if not coordinates:
+                    continue
+                coords = cmd.get_coords(part, -1 if state is None else state)
+                if coords is not None:
+                    digest.update(coords.tobytes())
+            xyz[obj] = digest.hexdigest()
+        return atoms.hexdigest(), xyz
+
+    def get(self, kind, selection, state, compute, coordinates=True):
+        """
+        Cached value of kind for the atoms of selection in state,
+        compute() on a miss
+        coordinates: whether the value depends on the coordinates
+        """
+        atoms, xyz = self.resolve(selection, state, coordinates)
+        key = (kind, atoms, state)
+        # Coordinates edited in place only show up in the digest
+        prints = {obj: self.fingerprint(obj) + (digest,) for obj, digest in xyz.items()}
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] == prints:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return entry[1]
+            self.drop(key)
+        self.misses += 1
+        value = freeze(compute())
+        self.put(key, prints, value)
+        return value
+
+    def put(self, key, prints, value):
+        size = sizeof(value)
+        if size > self.limit:
+            return
+        self.entries[key] = (prints, value, size)
+        self.nbytes += size
+        while self.nbytes > self.limit:
+            self.drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def drop(self, key):
+        _, _, size = self.entries.pop(key)
+        self.nbytes -= size
+
+    def invalidate(self, obj=None):
+        "Drop the entries of obj (default: all objects) and bump its version"
+        for name in ([obj] if obj is not None else cmd.get_object_list('(all)') or []):
+            self.versions[name] = self.versions.get(name, 0) + 1
+        stale = [key for key, (prints, _, _) in self.entries.items()
+                 if obj is None or obj in prints]
+        for key in stale:
+            self.drop(key)
+        self.invalidations += len(stale)
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+
+cache = SessionCache()
+
+
+def cached(kind, selection, state, compute, coordinates=True):
+    "shortcut for cache.get"
+    return cache.get(kind, selection, state, compute, coordinates)
+
+
+def invalidate(obj=None):
+    "shortcut for cache.invalidate"
+    cache.invalidate(obj)
+
+
+def cache_stats(action="stats", limit=None):
+    if limit is not None:
+        cache.limit = float(limit) * 2**20
+        while cache.nbytes > cache.limit:
+            cache.drop(next(iter(cache.entries)))
+            cache.evictions += 1
+    if action == "clear":
+        cache.clear()
+    elif action != "stats":
+        raise ValueError(f"Unknown action {action}, use stats or clear")
+    total = cache.hits + cache.misses
+    rate = cache.hits / total if total else 0.0
+    print(f"Session cache: {len(cache.entries)} entries, "
+          f"{cache.nbytes / 2**20:.1f}/{cache.limit / 2**20:.0f} MB")
+    print(f"  {cache.hits} hits, {cache.misses} misses ({rate:.0%} hit rate), "
+          f"{cache.evictions} evictions, {cache.invalidations} invalidated")
+
+cache_stats.__doc__ = __doc__
+cmd.extend('cache_stats', cache_stats)
+cmd.auto_arg[0]['cache_stats'] = [lambda: cmd.Shortcut(["stats", "clear"]), 'action', '']
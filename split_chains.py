@@ -2,39 +2,111 @@
 DESCRIPTION
     Split object into chains.
     By default chains are also colored.
+    With lazy=1 the object is renamed to a hidden _<object>_chains
+    and a chain object is only created when it is loaded with
+    load_chain (or merged). The default, eager split is unchanged.
 
 ARGUMENTS
     object: object to split (default: top object)
     color: color by chain (default: 1)
+    lazy: only create chain objects on load_chain (default: 0)
 
 EXAMPLE
     split_chains obj01
     split_chains color=0
+    split_chains capsid, lazy=1
+    load_chain capsid_A
 
 SEE ALSO
     merge_chains
 """
 author = "Matthijs J. Tadema, MSc (2020)"
-version = 20201214
+version = 20261018
 
-from pymol import cmd, util
+from pymol import cmd
+from pathlib import Path
+# Bit of a janky solution but have to inject the cache directory here...
+import sys
+cachedir = Path.home()/"mjtadema_pymol_cache"
+sys.path.append(str(cachedir.absolute()))
+from bulk_edit import bulk_edit
+import chain_store
+import session_cache
 
 
-def split_chains(obj=None, color=1):
+def split_create(obj):
+    """
+    One create per chain
+    The atoms are copied in C, which is much faster than loading
+    chempy models, and all states are kept.
+    return: new object names
+    """
+    names = []
+    for chain in cmd.get_chains(obj):
+        new_obj = obj+"_"+chain
+        # Quoted, so a blank chain identifier selects too
+        cmd.create(new_obj, f'{obj} and chain "{chain}"')
+        names.append(new_obj)
+    return names
+
+
+def split_chains(obj=None, color=1, lazy=0):
     if obj is None:
         obj = cmd.get_object_list()[0]
-    chains = cmd.get_chains(obj)
-    for chain in chains:
-        new_obj = obj+"_"+chain
-        cmd.create(new_obj, f"{obj} and chain {chain}")
-        cmd.color('atomic', new_obj)
-    cmd.center(obj)
-    cmd.delete(obj)
-    if int(color) == 1:
-        util.color_objs(f"elem c and {obj}_*")
+    with bulk_edit() as edit:
+        if int(lazy) == 1:
+            # Nothing is copied yet, load_chain creates each chain from the source
+            source = chain_store.source_name(obj)
+            cmd.set_name(obj, source)
+            cmd.disable(source)
+            names = []
+            # Remember the chain order so merge_chains can restore it
+            chain_store.order[obj] = []
+            for k, chain in enumerate(cmd.get_chains(source)):
+                carbon = chain_store.colors[k % len(chain_store.colors)] if int(color) == 1 else None
+                chain_store.pending[obj+"_"+chain] = (source, chain, carbon)
+                chain_store.order[obj].append(obj+"_"+chain)
+        else:
+            names = split_create(obj)
+            chain_store.order[obj] = list(names)
+            cmd.delete(obj)
+        session_cache.invalidate(obj)
+        if names:
+            new_objs = " ".join(names)
+            cmd.color('atomic', new_objs)
+            edit.center(new_objs)
+            if int(color) == 1:
+                edit.color_objs(f"elem c and ({new_objs})")
+    lazy_names = chain_store.pending_names(obj+"_")
+    if lazy_names:
+        print(f"{len(lazy_names)} chains ready for load_chain: {' '.join(lazy_names)}")
+    return names
+
+
+def load_chain(name):
+    """
+    DESCRIPTION
+        Create a chain object kept back by split_chains lazy=1
+
+    ARGUMENTS
+        name: chain object name, or a prefix to load several
+
+    EXAMPLE
+        load_chain capsid_A
+        load_chain capsid_
+    """
+    names = [name] if name in chain_store.pending else chain_store.pending_names(name)
+    if not names:
+        raise ValueError(f"No pending chain objects named {name}")
+    with bulk_edit():
+        for pending in names:
+            chain_store.materialize(pending)
+    return names
 
 split_chains.__doc__ = __doc__
 cmd.extend('split_chains', split_chains)
+cmd.extend('load_chain', load_chain)
 cmd.auto_arg[0]['split_chains'] = [cmd.object_sc, 'object', '']
+cmd.auto_arg[0]['load_chain'] = [lambda: cmd.Shortcut(list(chain_store.pending)), 'chain object', '']
 
 
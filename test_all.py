@@ -1,12 +1,20 @@
 from pymol import cmd
+import pytest
 from mindist import mindist
-from mutate import mutate
+from mutate import mutate, mutate_cache, rotamer_cache
 from fasta import fasta
-from axes import axes
-from split_chains import split_chains
+from axes import axes, axes_stats, dispatcher
+from split_chains import split_chains, load_chain
 from merge_chains import merge_chains
 from princ_align import princ_align
 from carve import carve
+from interface_matrix import interface_matrix
+from mutate_scan import mutate_scan
+from bulk_edit import bulk_edit
+import coords
+from session_cache import cache_stats
+from pathlib import Path
+import time
 
 cmd.fetch('4tsy')
 
@@ -14,19 +22,120 @@ def test_mindist_np():
     import numpy as np
     mindist("chain A", "chain D", n=10)
 
+def test_mindist_full():
+    mindist("chain A", "chain D", n=10, method="full")
+
+def test_mindist_chunked():
+    mindist("chain A", "chain D", n=10, unique=1, method="chunked", mem=8)
+
+def test_mindist_states(tmp_path):
+    mindist("chain A", "chain D", states="all", out=str(tmp_path/"mindist.csv"))
+    mindist("chain A", "chain D", states="1:1", out=str(tmp_path/"mindist.npy"))
+
+def test_mindist_output():
+    mindist("chain A", "chain D", n=20, output="single")
+    assert "mindist" in cmd.get_names()
+    mindist("chain A", "chain D", n=5, unique=1, output="single", name="mindist_unique")
+    assert len(cmd.get_raw_distances("mindist_unique")) == 5
+    atoms = cmd.count_atoms("all")
+    mindist("chain A", "chain D", n=20, output="cgo", label=1)
+    # The labels are part of the cgo, not atoms
+    assert cmd.count_atoms("all") == atoms
+
 def test_mindist_warn():
-    try:
+    # Only a warning, the pairs are still drawn
+    cmd.delete("mindist_*")
+    with pytest.warns(ResourceWarning):
         mindist("chain A", "chain D", n=10, _legacy=1)
-        raise RuntimeError
-    except ResourceWarning:
-        return 
+    assert any(name.startswith("mindist_") for name in cmd.get_names())
 
 def test_mindist():
     mindist("chain A and resi 10:12", "chain D and resi 10:12", n=10, unique=1)
 
+def test_interface_matrix(tmp_path):
+    interface_matrix('4tsy', out=str(tmp_path/"interfaces.csv"), processes=2)
+
+def test_interface_matrix_blank_chain():
+    cmd.create("blank", "4tsy")
+    cmd.alter("blank and chain A", "chain=''")
+    names, matrix, rows = interface_matrix('blank', processes=2)
+    cmd.delete("blank")
+    assert '' in names
+    assert (matrix[names.index('')] > 0).any()
+
 def test_mutate():
     mutate("resi 12", "R")
 
+def test_mutate_blank_chain():
+    cmd.create("blank", "4tsy and chain A")
+    cmd.alter("blank", "chain=''")
+    mutate("blank and resi 12", "A")
+    assert set(coords.get_fields("blank and resi 12", "resn")['resn']) == {"ALA"}
+    cmd.delete("blank")
+
+def test_mutate_cache():
+    mutate("resi 13", "K")
+    mutate("resi 13", "K")
+    assert rotamer_cache.hits > 0
+    mutate_cache()
+    mutate_cache("clear")
+
+def test_mutate_scan(tmp_path):
+    mutate_scan("resi 14 and chain A", aas="R K", processes=2, save=1, save_dir=str(tmp_path))
+
+def test_mutate_scan_one_worker():
+    # A single worker has to handle every task in turn
+    results = mutate_scan("resi 14 and chain A", aas="R K E H", processes=1)
+    assert len(results) == 4
+    assert all(n_rot > 0 for _, _, _, n_rot, _ in results)
+
+def test_bulk_edit():
+    before = cmd.get("suspend_updates")
+    try:
+        with bulk_edit():
+            assert cmd.get("suspend_updates") == "on"
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert cmd.get("suspend_updates") == before
+
+def test_coords():
+    xyz = coords.get_coords("4tsy and name CA")
+    fields = coords.get_fields("4tsy and name CA", "index", "resi")
+    assert xyz.shape == (len(fields['index']), 3)
+
+def test_cache_stats():
+    from session_cache import cache
+    first = coords.cached_coords("4tsy and name CA")
+    hits = cache.hits
+    assert coords.cached_coords("4tsy and name CA") is first
+    assert cache.hits == hits + 1
+    # Moved atoms are read again
+    cmd.translate([1, 0, 0], "4tsy and name CA", camera=0)
+    assert coords.cached_coords("4tsy and name CA") is not first
+    cmd.translate([-1, 0, 0], "4tsy and name CA", camera=0)
+    cache_stats()
+    cache_stats("clear", limit=64)
+
+def test_fresh_coordinates():
+    import numpy as np
+    from mindist import Selection
+    from carve import Slabs
+    cmd.select("probe", "4tsy and chain A and name CA")
+    before = Selection("probe")
+    Slabs("probe", "x")
+    cmd.translate([10, 0, 0], "probe", camera=0)
+    assert np.allclose(Selection("probe").coord - before.coord, [10, 0, 0])
+    assert np.allclose(Slabs("probe", "x").xyz - before.coord, [10, 0, 0])
+    cmd.alter_state(-1, "probe", "x = x - 10")
+    assert np.allclose(Selection("probe").coord, before.coord)
+    # A redefined named selection is read again
+    cmd.select("probe", "4tsy and chain D and name CA")
+    assert set(Selection("probe").chain) == {"D"}
+    assert set(Slabs("probe", "x").model) == {"4tsy"}
+    assert len(Slabs("probe", "x").xyz) == cmd.count_atoms("probe")
+    cmd.delete("probe")
+
 def test_fasta():
     fasta('(all)')
 
@@ -34,15 +143,177 @@ def test_axes():
     axes()
     axes(zero=1)
 
+def test_cgo_cache():
+    import cgo_cache
+    axes('axes_a')
+    axes('axes_b', zero=1)
+    cgo_cache.instance('plane_z', 'plane_test', cgo_cache.place((10, 10, 1)))
+    assert {'axes_a', 'axes_b', 'plane_test'} <= set(cmd.get_names('objects'))
+    assert {'axes', 'plane_z'} <= set(cgo_cache.templates)
+
+def test_axes_dispatcher():
+    axes('axes_1')
+    axes('axes_2')
+    assert {'axes_1', 'axes_2'} <= set(dispatcher.axes)
+    dispatcher.max_fps = 0
+    dispatcher()
+    dispatcher()
+    assert dispatcher.unchanged >= 1
+    # A throttled frame is redrawn later
+    dispatcher.max_fps = 10
+    dispatcher.prev_key = None
+    dispatcher.last = time.perf_counter()
+    dispatcher()
+    timer = dispatcher.catch_up
+    assert timer is not None
+    timer.join()
+    assert dispatcher.catch_up is None
+    dispatcher.max_fps = 60
+    axes_stats()
+
 def test_split_chains():
     split_chains('4tsy')
     
 def test_merge_chains():
     merge_chains('4tsy')
 
+def test_split_chains_lazy():
+    split_chains('4tsy', lazy=1)
+    load_chain('4tsy_A')
+    assert '4tsy_A' in cmd.get_names()
+    merge_chains('4tsy')
+    assert '_4tsy_chains' not in cmd.get_names('all')
+
 def test_princ_align():
+    import numpy as np
+    from princ_align import principal_axes
     princ_align('4tsy')
+    # All three axes end up on x, y and z, not just the largest
+    found = principal_axes('4tsy and name CA')
+    assert np.allclose(np.abs(found.axes), np.eye(3), atol=1e-6)
+
+def test_princ_align_states():
+    import numpy as np
+    from princ_align import principal_axes_states
+    rng = np.random.default_rng(0)
+    body = rng.normal(size=(100, 3)) * [10, 5, 2]
+    # The same molecule in a random orientation in every state
+    rotations, _ = np.linalg.qr(rng.normal(size=(50, 3, 3)))
+    rotations *= np.sign(np.linalg.det(rotations))[:, None, None]
+    xyz = np.einsum('fij,nj->fni', rotations, body) + rng.normal(size=(50, 1, 3))
+    found = principal_axes_states(xyz)
+    assert np.allclose(np.linalg.det(found.axes), 1)
+    aligned = np.einsum('fij,fnj->fni', found.axes, xyz - found.center[:, None])
+    assert np.allclose(aligned, aligned[0])
+    princ_align('4tsy', states='all')
+
+def test_princ_align_weighted():
+    import numpy as np
+    from princ_align import principal_axes, principal_axes_states
+    found = princ_align('4tsy', atoms='heavy', weight=1)
+    assert found.axes.shape == (3, 3)
+    assert (np.diff(found.eigenvalues) <= 0).all()
+    # Streaming over small chunks gives the same axes as all atoms at once
+    streamed = principal_axes('4tsy and not hydro', chunk=500)
+    stacked = principal_axes_states(coords.get_coords('4tsy and not hydro')[None])
+    assert np.allclose(streamed.center, stacked.center[0])
+    assert np.allclose(streamed.axes, stacked.axes[0])
     
 def test_carve():
     carve('4tsy', view_key='F1')
+
+def test_carve_slab():
+    atoms, residues = carve('4tsy', '10', axis='z', name='pore', planes=1)
+    assert cmd.count_atoms('pore') == atoms
+    assert {'pore_lo', 'pore_hi'} <= set(cmd.get_names('objects'))
+    assert 0 < residues <= atoms
+
+def test_carve_series(tmp_path):
+    carve('4tsy', '-10:20')
+    paths = carve('4tsy', '-10:10', thickness=5, step=5, out=str(tmp_path/"slab"),
+                  width=100, height=100, processes=2)
+    assert len(paths) == 4
+    assert all(Path(path).exists() for path in paths)
     
+
+def test_loader(tmp_path, monkeypatch):
+    import hashlib
+    import http.server
+    import json
+    import threading
+    import loader
+    files = {'hello.py': b"print('hello')\n", 'world.py': b"print('world')\n"}
+    statuses = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            name = self.path.strip("/")
+            if name == "contents":
+                if self.headers.get('If-None-Match') == '"v1"':
+                    statuses.append(304)
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                base = f"http://127.0.0.1:{self.server.server_port}"
+                body = json.dumps([
+                    {'name': name, 'download_url': f"{base}/{name}",
+                     'sha': hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()}
+                    for name, data in files.items()]).encode()
+                headers = {'ETag': '"v1"'}
+            else:
+                body, headers = files[name], {}
+            statuses.append(200)
+            self.send_response(200)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/contents"
+    try:
+        with loader.make_session() as session:
+            modules = loader.list_modules(loader.get_listing(session, tmp_path, url))
+            assert sorted(loader.update_modules(session, modules, tmp_path)) == sorted(files)
+            assert (tmp_path/"hello.py").read_bytes() == files['hello.py']
+            assert set(loader.read_manifest(tmp_path)) == set(files)
+            # Unchanged files are checked from the manifest, without hashing
+            with monkeypatch.context() as patch:
+                patch.setattr(loader, 'blob_hash', None)
+                assert loader.update_modules(session, modules, tmp_path) == []
+            (tmp_path/"hello.py").write_bytes(b"print('changed')\n")
+            assert loader.update_modules(session, modules, tmp_path) == ['hello.py']
+            # An expired list is revalidated instead of downloaded again
+            loader.get_listing(session, tmp_path, url, max_age=0)
+            assert statuses[-1] == 304
+    finally:
+        server.shutdown()
+
+def test_loader_lazy(tmp_path):
+    import sys
+    import loader
+    (tmp_path/"lazy_demo.py").write_text(
+        "from pymol import cmd\n"
+        "calls = []\n"
+        "def lazy_demo(selection='all'):\n"
+        "    'demo command'\n"
+        "    calls.append(selection)\n"
+        "cmd.extend('lazy_demo', lazy_demo)\n"
+        "cmd.auto_arg[0]['lazy_demo'] = [cmd.selection_sc, 'selection', '']\n")
+    index = loader.update_index({'lazy_demo.py': ('', '')}, tmp_path)
+    assert (tmp_path/"commands.json").exists()
+    loader.register_stubs(index, tmp_path)
+    assert 'lazy_demo' not in sys.modules
+    assert cmd.keyword['lazy_demo'][0].__doc__ == 'demo command'
+    assert cmd.auto_arg[0]['lazy_demo'][1] == 'selection'
+    # The first call imports the module, which registers the real command,
+    # through the parser like a user would, which also passes _self
+    cmd.do("lazy_demo chain A", echo=0)
+    assert 'lazy_demo' in sys.modules
+    assert sys.modules['lazy_demo'].calls == ['chain A']
+    assert cmd.keyword['lazy_demo'][0] is sys.modules['lazy_demo'].lazy_demo